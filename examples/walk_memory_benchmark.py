@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""Compare peak memory of os.walk and utils.walk.walk_tree (unsorted and sorted) on a synthetic tree.
+
+Builds (once) a tree shaped like a large fmriprep derivative folder - many
+subjects and sessions plus a few very large flat directories - then walks
+it in fresh subprocesses so that each peak RSS is measured on its own.
+
+Usage:
+    python examples/walk_memory_benchmark.py /tmp/walk_bench --files 1000000
+"""
+
+import argparse
+import os
+import subprocess as sp
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+WALKERS = {
+    "os.walk": """
+import os
+n = 0
+for root, dirs, files in os.walk(top):
+    for name in files:
+        os.lstat(os.path.join(root, name))
+        n += 1
+""",
+    "walk_tree": """
+from utils.walk import walk_tree
+n = 0
+for relpath, entry, depth in walk_tree(top):
+    if not entry.is_dir(follow_symlinks=False):
+        entry.stat(follow_symlinks=False)
+        n += 1
+""",
+    # the order used to build reproducible archives (utils.archive.archive_members)
+    "walk_tree sorted": """
+from utils.walk import walk_tree
+n = 0
+for relpath, entry, depth in walk_tree(top, sort=True):
+    if not entry.is_dir(follow_symlinks=False):
+        entry.stat(follow_symlinks=False)
+        n += 1
+""",
+}
+
+
+def build_tree(top, nfiles, flat_fraction=0.5):
+    """Create nfiles empty files below top, flat_fraction of them in 4 flat directories."""
+    marker = os.path.join(top, ".complete_%d" % nfiles)
+    if os.path.exists(marker):
+        return
+    flat = int(nfiles * flat_fraction)
+    for d in range(4):
+        path = os.path.join(top, "flat%d" % d)
+        os.makedirs(path, exist_ok=True)
+        for i in range(flat // 4):
+            open(os.path.join(path, "sub-%07d_desc-confounds_timeseries.tsv" % i), "w").close()
+
+    per_session = 50
+    sessions = (nfiles - flat) // per_session
+    for s in range(sessions):
+        path = os.path.join(top, "sub-%05d" % (s // 4), "ses-%02d" % (s % 4), "func")
+        os.makedirs(path, exist_ok=True)
+        for i in range(per_session):
+            open(os.path.join(path, "sub-%05d_run-%02d_bold.nii.gz" % (s // 4, i)), "w").close()
+    open(marker, "w").close()
+
+
+def measure(name, top):
+    code = "top = %r\n" % top + WALKERS[name] + """
+import resource, sys
+sys.stdout.write("%d %d" % (n, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+"""
+    baseline = sp.run([sys.executable, "-c", "import resource, sys; sys.stdout.write("
+                       "str(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))"],
+                      capture_output=True, text=True, check=True)
+    start = time.monotonic()
+    out = sp.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                 cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    elapsed = time.monotonic() - start
+    n, maxrss = map(int, out.stdout.split())
+    return n, (maxrss - int(baseline.stdout)) / 1024, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("top", help="directory the synthetic tree is (or was) built in")
+    parser.add_argument("--files", type=int, default=1000000, help="number of files in the tree")
+    args = parser.parse_args()
+
+    build_tree(args.top, args.files)
+    for name in WALKERS:
+        n, peak_mb, elapsed = measure(name, args.top)
+        print("%-17s %9d files  peak RSS above interpreter %7.1f MB  %6.1fs" % (name, n, peak_mb, elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -5,18 +5,31 @@ from getpass import getpass
 from pathlib import Path
 import os, sys
 import logging
+import queue
+import re
+import shutil
+import signal
+import sqlite3
+import threading
+import time
 
-import pandas as pd
-import flywheel
-from flywheel_gear_toolkit.utils.zip_tools import unzip_archive, zip_output
 from datetime import datetime as dt
 import argparse
 from functools import partial
-import subprocess as sp
 import glob
 
 # contains all functions specific to fmriprep flywheel uploads
-from utils.utils import get_project_id, analysis_exists, zip_htmls
+from utils.utils import get_project_id, analysis_exists, latest_analysis, zip_fmriprep_report
+from utils.archive import (ARCHIVE_FORMATS, DEFAULT_COMPRESSION_POLICY, available_cpus, build_archive,
+                           load_compression_policy)
+from utils.tool_cache import cached_tool_help
+from utils.archive_cache import cached_archive
+from utils.governor import RequestGovernor, is_retryable
+from utils.manifest import MANIFEST_NAME, build_manifest, files_to_sync, read_manifest, write_manifest
+from utils.watch import DerivativeWatcher
+from utils.layout_index import LayoutIndex, with_prefix
+from utils.walk import disk_usage, human_size, walk_tree
+from utils.verify import UploadRecord, verify_uploads, write_report
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
 log = logging.getLogger(__name__)
@@ -24,9 +37,37 @@ log = logging.getLogger(__name__)
 # set version
 __version__ = "0.0.1"
 
+# label used to find existing fmriprep analyses in flywheel
+ANALYSIS_NAME = 'fmriprep'
+
+# label prefix of the analyses created by this tool (the only ones --sync adds files to)
+UPLOAD_LABEL = 'bids-fmriprep: Upload'
+
+# seconds to wait for the optional layout index before continuing without it
+LAYOUT_TIMEOUT = 5
+
+# sessions already handled in watch mode (kept in SRC so restarts skip them)
+WATCH_STATE = '.fmriprep_upload_watch.json'
+
 
 # define functions here...
 
+def flywheel_client():
+    """Create a flywheel client using CLI credentials.
+
+    flywheel is imported here rather than at module level, loading the sdk
+    takes seconds and is not needed for --help or argument validation.
+    """
+    import flywheel
+
+    fw = flywheel.Client()
+
+    # who am I logged in as?
+    log.info('You are now logged in as %s to %s', fw.get_current_user()['email'],
+             fw.get_config()['site']['api_url'])
+    return fw
+
+
 def parser(context):
     # parse inputs similarly to cli ingest bids function
 
@@ -94,6 +135,145 @@ def parser(context):
         action="store_true",
         help="ignore check for previously created fmriprep analyses in flywheel session",
     )
+    parser.add_argument(
+        "--sync",
+        action="store_true",
+        help="upload only files missing or different in the latest existing fmriprep analysis (a new analysis is created if none exists)",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="keep running and upload each sub-*/ses-* session as soon as fmriprep finishes it",
+    )
+    parser.add_argument(
+        "--watch-interval",
+        action="store",
+        type=float,
+        default=300,
+        help="seconds between scans of SRC in watch mode"
+    )
+    parser.add_argument(
+        "--quiet-period",
+        action="store",
+        type=float,
+        default=3600,
+        help="in watch mode, a session no log names is complete once unchanged for this many seconds"
+    )
+    parser.add_argument(
+        "--workers",
+        action="store",
+        type=int,
+        default=2,
+        help="number of sessions uploaded in parallel in watch mode"
+    )
+    parser.add_argument(
+        "--queue-size",
+        action="store",
+        type=int,
+        default=4,
+        help="finished sessions waiting for a worker before scanning pauses (watch mode)"
+    )
+    parser.add_argument(
+        "--max-attempts",
+        action="store",
+        type=int,
+        default=5,
+        help="in watch mode, failed uploads of a session (retried with growing delays) before it is given up"
+    )
+    parser.add_argument(
+        "--layout-index",
+        action="store",
+        metavar="PATH",
+        help="opt-in sqlite index of SRC shared by runs on this machine (e.g. ~/.cache/data_ingestion_tools/layout/src.sqlite), "
+             "used to report selected sessions and discover sessions in watch mode; keep it off shared filesystems used by job arrays"
+    )
+    parser.add_argument(
+        "--compression-policy",
+        action="store",
+        metavar="PATH",
+        type=IsFile,
+        help="JSON file mapping file globs to stored, deflate[:level] or auto, checked before the built-in policy"
+    )
+    parser.add_argument(
+        "--derivs-format",
+        action="store",
+        choices=ARCHIVE_FORMATS,
+        default="zip",
+        help="archive format of the fmriprep derivatives; tar formats compress on several cores but cannot be browsed in flywheel"
+    )
+    parser.add_argument(
+        "--logs-format",
+        action="store",
+        choices=ARCHIVE_FORMATS,
+        default="zip",
+        help="archive format of the logs"
+    )
+    parser.add_argument(
+        "--compress-threads",
+        action="store",
+        type=int,
+        default=available_cpus(),
+        help="compression threads used for tar.zst / tar.gz archives, defaults to the cores allocated to this job"
+    )
+    parser.add_argument(
+        "--tool-cmd",
+        action="store",
+        help="command used to run fmriprep (e.g. 'singularity run --cleanenv fmriprep.sif'), used to create a missing analysis_information.txt"
+    )
+    parser.add_argument(
+        "--archive-cache",
+        action="store",
+        metavar="PATH",
+        help="directory caching archives shared across sessions (logs, scripts), defaults to ~/.cache/data_ingestion_tools/archives"
+    )
+    parser.add_argument(
+        "--archive-cache-size",
+        action="store",
+        type=float,
+        default=10,
+        help="size bound of the archive cache in GB, least recently used archives are evicted first"
+    )
+    parser.add_argument(
+        "--no-archive-cache",
+        action="store_true",
+        help="always rebuild shared archives"
+    )
+    parser.add_argument(
+        "--api-concurrency",
+        action="store",
+        type=int,
+        default=8,
+        help="maximum number of concurrent flywheel API requests, lowered automatically on throttling, errors or slow responses"
+    )
+    parser.add_argument(
+        "--max-transfers",
+        action="store",
+        type=int,
+        default=4,
+        help="maximum number of concurrent file uploads / downloads, kept apart from the API request limit"
+    )
+    parser.add_argument(
+        "--upload-record",
+        action="store",
+        metavar="PATH",
+        help="JSON lines file the expected names and sizes of every uploaded analysis are appended to"
+    )
+    parser.add_argument(
+        "--verify-report",
+        action="store",
+        metavar="PATH",
+        help="where the verification report of the batch is written, defaults to SRC/upload_verification_<date>.json"
+    )
+    parser.add_argument(
+        "--verify-only",
+        action="store_true",
+        help="do not upload, verify (and re-upload mismatches of) the analyses listed in --upload-record"
+    )
+    parser.add_argument(
+        "--no-verify",
+        action="store_true",
+        help="skip checking the uploaded analyses at the end of the batch"
+    )
     parser.add_argument("-v", "--verbosity", action="count", default=0)
 
     args = parser.parse_args()
@@ -101,6 +281,12 @@ def parser(context):
     if args.session and (args.subject is None):
         parser.error("--session must be defined with --subject")
 
+    if args.watch and args.subject:
+        parser.error("--watch discovers sessions itself, it cannot be combined with --subject / --session")
+
+    if args.verify_only and not (args.upload_record and os.path.isfile(args.upload_record)):
+        parser.error("--verify-only needs an existing --upload-record file")
+
     # add all args to context
     args_dict = args.__dict__
     context.update(args_dict)
@@ -109,16 +295,6 @@ def parser(context):
     #    Argument Checks     #
     ##########################
 
-    # project and group exist in flywheel (needed later for fw.lookup())
-    project_id = get_project_id(context['fw'], args.project)
-    if project_id:
-        # check correct group assignment
-        project = context['fw'].get_project(project_id)
-        if not project.group == args.group:
-            parser.error("No group and project match found in " + context['fw'].get_config()['site']['api_url'])
-    else:
-        parser.error("No group and project match found in " + context['fw'].get_config()['site']['api_url'])
-
     # check necessary upload files exist
     if not args.log_path:
         context['log_path'] = os.path.join(args.SRC, 'logs')
@@ -126,6 +302,16 @@ def parser(context):
     if not args.scripts_path:
         context['scripts_path'] = os.path.join(args.SRC, 'scripts')
 
+    # create missing metadata files from the logs / tool itself
+    config_file = os.path.join(context['SRC'], 'analysis_configuration.txt')
+    info_file = os.path.join(context['SRC'], 'analysis_information.txt')
+    if not os.path.exists(config_file) and os.path.exists(context['log_path']):
+        if not generate_analysis_config(context['log_path'], config_file):
+            os.remove(config_file)
+    if not os.path.exists(info_file) and context['tool_cmd']:
+        if not generate_analysis_info(context['tool_cmd'], info_file):
+            parser.error("No help output from --tool-cmd, unable to create " + info_file)
+
     checklist = [context['log_path'],
                  context['scripts_path'],
                  os.path.join(context['SRC'], 'analysis_configuration.txt'),
@@ -141,15 +327,43 @@ def parser(context):
     context['log_path'] = os.path.abspath(context['log_path'])
     context['scripts_path'] = os.path.abspath(context['scripts_path'])
 
+    # archive compression policy (None uses the built-in policy)
+    if context['compression_policy']:
+        try:
+            context['compression_policy'] = load_compression_policy(context['compression_policy'])
+        except ValueError as e:
+            parser.error(str(e))
+
+    # expected names and sizes of every analysis uploaded in this batch, checked by verify_batch()
+    if context['verify_only']:
+        context['upload_record'] = UploadRecord.load(context['upload_record'])
+    else:
+        context['upload_record'] = UploadRecord(context['upload_record'])
+    if not context['verify_report']:
+        context['verify_report'] = os.path.join(context['SRC'],
+                                                'upload_verification_' + dt.now().strftime('%Y%m%d_%H%M%S') + '.json')
+
+    # optional persistent index of SRC, only changed directories are re-read
+    context['layout'] = None
+    if context['layout_index']:
+        try:
+            context['layout'] = LayoutIndex(context['SRC'], context['layout_index'], timeout=LAYOUT_TIMEOUT)
+        except (sqlite3.Error, OSError) as e:
+            log.warning('Layout index %s unavailable, continuing without it: %s', context['layout_index'], e)
+
     # pull analysis derivative path
-    if context['subject'] and context['session']:
-        subj = context['subject'].strip('sub-')
-        ses = context['session'].strip('ses-')
-        bidspath = os.path.join(context['SRC'], 'sub-' + subj, 'ses-' + ses)
+    if context['watch'] or context['verify_only']:
+        # sessions are discovered while watching (see watch()) or listed in the upload record
+        context['run_level'] = 'session'
+        bidspath = context['SRC']
+    elif context['subject'] and context['session']:
+        subj = with_prefix(context['subject'], 'sub-')
+        ses = with_prefix(context['session'], 'ses-')
+        bidspath = os.path.join(context['SRC'], subj, ses)
         context['run_level'] = 'session'
     elif context['subject'] and not context['session']:
-        subj = context['subject'].strip('sub-')
-        bidspath = os.path.join(context['SRC'], 'sub-' + subj)
+        subj = with_prefix(context['subject'], 'sub-')
+        bidspath = os.path.join(context['SRC'], subj)
         context['run_level'] = 'subject'
     else:
         parser.error('Unknown subject and session configuration')
@@ -157,7 +371,31 @@ def parser(context):
     if os.path.exists(bidspath):
         context['bidspath'] = bidspath
     else:
-        parser.error('Fmriprep derivatives dataset not present: ' + bidspath)
+        parser.error('Fmriprep derivatives dataset not present: ' + bidspath
+                     + known_labels(context, os.path.relpath(bidspath, context['SRC'])))
+
+    if not (context['watch'] or context['verify_only']):
+        log_selection(context, os.path.relpath(bidspath, context['SRC']))
+
+    # local checks passed - only now pay for loading the flywheel sdk
+    if 'fw' not in context:
+        context['fw'] = flywheel_client()
+
+    # every flywheel request goes through one shared, adaptive concurrency limit
+    if 'governor' not in context:
+        context['governor'] = RequestGovernor(max_concurrency=context['api_concurrency'],
+                                              max_transfers=context['max_transfers'])
+    gov = context['governor']
+
+    # project and group exist in flywheel (needed later for fw.lookup())
+    project_id = gov.call(get_project_id, context['fw'], args.project)
+    if project_id:
+        # check correct group assignment
+        project = gov.call(context['fw'].get_project, project_id)
+        if not project.group == args.group:
+            parser.error("No group and project match found in " + context['fw'].get_config()['site']['api_url'])
+    else:
+        parser.error("No group and project match found in " + context['fw'].get_config()['site']['api_url'])
 
     # end parser
 
@@ -168,161 +406,598 @@ def main(context):
     # parse user inputs and store in context
     parser(context)
 
+    if context['verify_only']:
+        report = verify_batch(context)
+        log.info('Flywheel API requests: %s', context['governor'].stats())
+        sys.exit(1 if report['failed'] else 0)
+
+    if context['watch']:
+        given_up = watch(context)
+        report = None
+        if not context['no_verify']:
+            report = verify_batch(context, given_up)
+        log.info('Flywheel API requests: %s', context['governor'].stats())
+        for entry in given_up:
+            log.error('Gave up on %s %s after %d failed uploads', entry['subject'], entry['session'],
+                      entry['attempts'])
+        if (report and report['failed']) or given_up:
+            sys.exit(1)
+        return
+
     # print all files (and file sizes for zip and upload)
     data_tree(context['SRC'], os.path.join(context['SRC'], 'data_tree.txt'))
 
     # check if conditions are met for upload (any duplicates?)
-    analysis_name = 'fmriprep'
-    fw = context['fw']
-    if context['run_level'] == 'session':
-        ctn = fw.lookup(
-            context['group'] + '/' + context['project'] + '/' + context['subject'] + '/' + context['session'])
-        session = fw.get_session(ctn.id)
-        if analysis_exists(session, analysis_name) and not context['allow_multiples']:
-            log.exception('Analysis already exists in flywheel container: %s', ctn.id)
-            sys.exit(1)
-
-    elif context['run_level'] == 'subject':
-        ctn = fw.lookup(context['group'] + '/' + context['project'] + '/' + context['subject'])
-        subject = fw.get_subject(ctn.id)
-        if analysis_exists(subject, analysis_name) and not context.allow_multiples:
-            log.exception('Analysis already exists in flywheel container: %s', ctn.id)
-            sys.exit(1)
+    if analysis_blocked(context):
+        sys.exit(1)
 
     # begin analysis upload!
     print('starting upload')
-    upload_analysis(context)
+    uploaded = upload_analysis(context)
+    if not uploaded:
+        log.error('Upload of %s failed', os.path.relpath(context['bidspath'], context['SRC']))
 
     # check outputs
-    # ...
+    report = None
+    if not context['no_verify']:
+        report = verify_batch(context)
 
+    log.info('Flywheel API requests: %s', context['governor'].stats())
 
-def generate_analysis_info(cmd):
-    Results = sp.Popen(
-        cmd + " -h", shell=True, stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True
-    )
-    stdout, _ = Results.communicate()
-    log.info("\n %s", stdout)
-    file = open("analysis_information.txt", "w")
-    file.write(stdout)
-    file.close()
+    # a failed upload only counts as done if verification completed its analysis
+    repaired = report is not None and report['analyses'] > 0 and not report['failed']
+    if (report and report['failed']) or not (uploaded or repaired):
+        sys.exit(1)
 
 
-def generate_analysis_config():
-    log.info("Function under active development. Come back later!!")
+def analysis_blocked(context):
+    """Return True if a fmriprep analysis exists and neither --allow-multiples nor --sync is set."""
+    fw_container = get_container(context)
+    if analysis_exists(fw_container, ANALYSIS_NAME) and not (context['allow_multiples'] or context['sync']):
+        log.error('Analysis already exists in flywheel container: %s', fw_container.id)
+        return True
+    return False
 
 
-def upload_analysis(context):
-    fw = context['fw']
+def known_labels(context, relpath):
+    """Return the subjects or sessions the layout index knows of, to explain a missing relpath.
 
-    # set container for upload (subject or session)
-    if context['run_level'] == 'session':
-        ctn = fw.lookup(
-            context['group'] + '/' + context['project'] + '/' + context['subject'] + '/' + context['session'])
-        fw_container = fw.get_session(ctn.id)
-    elif context['run_level'] == 'subject':
-        ctn = fw.lookup(context['group'] + '/' + context['project'] + '/' + context['subject'])
-        fw_container = fw.get_subject(ctn.id)
+    Args:
+        context (dict): run context
+        relpath (str): missing subject or subject/session, relative to SRC
 
+    Returns:
+        (str): e.g. " (sessions of sub-01: ses-01, ses-02)", empty without a usable index
+    """
+    if context['layout'] is None:
+        return ''
+    subject = relpath.split(os.sep)[0]
     try:
-        # create temporary upload location
-        os.system('mkdir -p ' + os.path.join(context['SRC'], 'tmp_upload'))
+        context['layout'].refresh(depth=2)
+        sessions = [session for _, session in context['layout'].sessions(subject)]
+        if sessions:
+            return ' (sessions of %s: %s)' % (subject, ', '.join(sessions))
+        subjects = context['layout'].subjects()
+        return ' (subjects: %s%s)' % (', '.join(subjects[:20]), ', ...' if len(subjects) > 20 else '')
+    except (sqlite3.Error, OSError):
+        return ''
+
+
+def log_selection(context, relpath):
+    """Log the subject / session selected for upload, with its size if the layout index is enabled.
+
+    The index is an optimization only: a locked or unreadable database is
+    logged and never stops an upload.
+    """
+    if context['layout'] is None:
+        log.info('Selected %s', relpath)
+        return
+    try:
+        context['layout'].refresh(relpath)
+        nfiles = context['layout'].files(*relpath.split(os.sep))
+    except (sqlite3.Error, OSError) as e:
+        log.warning('Layout index %s unavailable: %s', context['layout_index'], e)
+        log.info('Selected %s', relpath)
+        return
+    log.info('Selected %s: %d files, %s', relpath, len(nfiles), human_size(sum(size for _, size in nfiles)))
+
+
+def session_context(context, subject, session):
+    """Return a copy of the run context targeting a single sub-*/ses-* session."""
+    ses_context = dict(context)
+    ses_context.update(subject=subject, session=session, run_level='session',
+                       bidspath=os.path.join(context['SRC'], subject, session))
+    return ses_context
+
+
+def watch(context):
+    """Upload sessions as fmriprep finishes them, until interrupted (Ctrl-C / SIGTERM).
+
+    A scanner thread (this one) feeds finished sessions into a bounded
+    queue drained by --workers upload threads, each going through the
+    normal upload path with its own copy of the context. Failed sessions
+    are retried after --watch-interval seconds, doubled per attempt, and
+    given up after --max-attempts failures.
+
+    Returns:
+        (list): sessions given up, see DerivativeWatcher.retry
+    """
+    watcher = DerivativeWatcher(context['SRC'], context['log_path'], quiet_period=context['quiet_period'],
+                                state_file=os.path.join(context['SRC'], WATCH_STATE),
+                                max_attempts=context['max_attempts'], retry_delay=context['watch_interval'],
+                                layout=context['layout'])
+    sessions = queue.Queue(maxsize=max(context['queue_size'], 1))
+
+    failed = set()
+
+    def worker():
+        while True:
+            key = sessions.get()
+            if key is None:
+                break
+            ses_context = session_context(context, *key)
+            if key in failed:
+                # complete the analysis a failed attempt may have left half-filled
+                ses_context['sync'] = True
+            error = 'upload failed'
+            try:
+                log_selection(context, os.path.join(*key))
+                if analysis_blocked(ses_context) or upload_analysis(ses_context):
+                    failed.discard(key)
+                    watcher.mark_done(key)
+                    continue
+            except Exception as e:
+                log.error('Upload of %s %s failed: %s', key[0], key[1], e)
+                error = str(e)
+            failed.add(key)
+            if not watcher.retry(key, error):
+                failed.discard(key)
+
+    workers = [threading.Thread(target=worker, daemon=True) for _ in range(max(context['workers'], 1))]
+    for w in workers:
+        w.start()
+
+    # job schedulers stop jobs with SIGTERM, let running uploads finish
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    log.info('Watching %s for finished sessions', context['SRC'])
+    try:
+        while True:
+            for key in watcher.scan():
+                log.info('Queueing finished session %s %s', key[0], key[1])
+                sessions.put(key)  # blocks while the queue is full
+            time.sleep(context['watch_interval'])
+    except KeyboardInterrupt:
+        log.info('Stopping watch, waiting for queued uploads to finish')
+    finally:
+        for _ in workers:
+            sessions.put(None)
+        for w in workers:
+            w.join()
+    return [watcher.given_up[key] for key in sorted(watcher.given_up)]
+
+
+def generate_analysis_info(cmd, output_file, cache_dir=None):
+    """Write the help text of the analysis tool to output_file.
+
+    The help text is cached per executable / container image (see
+    utils.tool_cache) so a batch of sessions starts the container once.
+
+    Args:
+        cmd (str): command used to run the tool, e.g. "singularity run --cleanenv fmriprep.sif"
+        output_file (str): where analysis_information.txt should be written
+        cache_dir (str): optional location of the tool information cache
+
+    Returns:
+        (str): the help text, output_file is not written if it is empty
+    """
+    stdout = cached_tool_help(cmd, cache_dir=cache_dir)
+    log.debug("\n %s", stdout)
+    if not stdout.strip():
+        return stdout
+    with open(output_file, "w") as file:
+        file.write(stdout)
+    return stdout
+
+
+# fmriprep logs the command it was launched with and a summary block such as
+#   Running fMRIPrep version 21.0.2:
+#     * BIDS dataset path: /data.
+#     * Participant list: ['10462'].
+CONFIG_HEADER = re.compile(r"Running fMRIPrep", re.IGNORECASE)
+CONFIG_ITEM = re.compile(r"^\s*\*\s+(.+)$")
+CONFIG_COMMAND = re.compile(r"\bfmriprep\b.*\bparticipant\b", re.IGNORECASE)
+
+
+def generate_analysis_config(log_path, output_file):
+    """Extract the fmriprep run configuration from its logs.
+
+    Every log is read once, line by line, so memory use does not depend
+    on the size of the logs.
+
+    Args:
+        log_path (str): fmriprep log file or directory of logs
+        output_file (str): where analysis_configuration.txt should be written
+
+    Returns:
+        (bool): True if any configuration was found
+    """
+    if os.path.isdir(log_path):
+        logs = sorted(entry.path for _, entry, _ in walk_tree(log_path) if entry.is_file())
+    else:
+        logs = [log_path]
+
+    found = False
+    with open(output_file, "w") as out:
+        for logfile in logs:
+            in_block = named = False
+            with open(logfile, errors="replace") as f:
+                for line in f:
+                    header = CONFIG_HEADER.search(line)
+                    if in_block and not header and CONFIG_ITEM.match(line):
+                        out.write("    " + line.strip() + "\n")
+                        continue
+                    in_block = False
+                    if header or CONFIG_COMMAND.search(line):
+                        if not named:
+                            # name the log once, before its first configuration line
+                            out.write("# " + os.path.basename(logfile) + "\n")
+                            named = True
+                        out.write(line.strip() + "\n")
+                        in_block = bool(header)
+                        found = True
+
+    if not found:
+        log.warning("No fmriprep configuration found in logs: %s", log_path)
+    return found
+
+
+def archive_shared(context, source_path, output_file, fmt='zip'):
+    """Archive a directory that is often identical across sessions (logs, scripts).
+
+    Archives are reused from the content-addressed archive cache unless
+    --no-archive-cache is set.
+    """
+    relpath = os.path.relpath(source_path, context['SRC'])
+    build = partial(build_archive, fmt, policy=context['compression_policy'], threads=context['compress_threads'])
+
+    if context['no_archive_cache']:
+        build(context['SRC'], relpath, output_file)
+    else:
+        cached_archive(context['SRC'], relpath, output_file, build,
+                       extra=repr(context['compression_policy'] or DEFAULT_COMPRESSION_POLICY),
+                       cache_dir=context['archive_cache'],
+                       max_bytes=int(context['archive_cache_size'] * 1024 ** 3))
+
 
-        # zip fmriprep results except for scratch
+def get_container(context):
+    """Return the full flywheel subject or session targeted by the upload."""
+    fw = context['fw']
+    gov = context['governor']
+    if context['run_level'] == 'session':
+        ctn = gov.call(fw.lookup,
+                       context['group'] + '/' + context['project'] + '/' + context['subject'] + '/' + context['session'])
+        return gov.call(fw.get_session, ctn.id)
+    elif context['run_level'] == 'subject':
+        ctn = gov.call(fw.lookup, context['group'] + '/' + context['project'] + '/' + context['subject'])
+        return gov.call(fw.get_subject, ctn.id)
+
+
+def create_analysis(context, fw_container, label):
+    """Create an analysis on the target container without ever creating two.
+
+    add_analysis is not idempotent: a 5xx or dropped connection may arrive
+    after the server created the analysis. Before each retry the
+    container is read again and an analysis with the same label is reused.
+    """
+    gov = context['governor']
+    attempt = 0
+    while True:
+        try:
+            return gov.call_once(fw_container.add_analysis, label=label)
+        except Exception as e:
+            if not is_retryable(e) or attempt >= gov.retries:
+                raise
+            fw_container = get_container(context)
+            existing = [analysis for analysis in fw_container.analyses if analysis.label == label]
+            if existing:
+                log.info('Analysis %s was created despite the error (%s)', existing[0].id, e)
+                return existing[0]
+            delay = gov.backoff * 2 ** attempt
+            log.warning('Creating analysis failed (%s), retrying in %.1fs', e, delay)
+            attempt += 1
+            time.sleep(delay)
+
+
+def build_uploads(context, upload_dir, only=None):
+    """Zip / copy everything that should be attached to the analysis into upload_dir.
+
+    Args:
+        context (dict): run context of one subject or session
+        upload_dir (str): directory the files are written to
+        only (set, optional): names of the files to build, e.g. to repair an
+            analysis without rebuilding its derivative archive
+
+    Returns:
+        (dict): manifest of the files built, also written to upload_dir unless only is set
+    """
+    def wanted(name):
+        return only is None or name in only
+
+    # zip fmriprep results except for scratch
+    derivs_name = 'bids-fmriprep.' + context['derivs_format']
+    if wanted(derivs_name):
         log.info('Zipping contents of directory %s', context['bidspath'])
         relpath = os.path.relpath(context['bidspath'], context['SRC'])
-        zip_output(context['SRC'], relpath, os.path.join(context['SRC'], 'tmp_upload', 'bids-fmriprep.zip'),
-                   exclude_files=['scratch'])
-
-        # zip logs
-        log.info('Zipping logs %s', context['log_path'])
-        if os.path.isdir(context['log_path']):
-            # TODO - currently treat log path as only containing relevant log info. I need to develop a sort or filter method!
-            relpath = os.path.relpath(context['log_path'], context['SRC'])
-            zip_output(context['SRC'], relpath, os.path.join(context['SRC'], 'tmp_upload', 'logs.zip'))
-        else:
-            os.system('cp ' + context['log_path'] + ' ' + os.path.join(context['SRC'], 'tmp_upload'))
+        build_archive(context['derivs_format'], context['SRC'], relpath, os.path.join(upload_dir, derivs_name),
+                      exclude_files=['scratch'], policy=context['compression_policy'],
+                      threads=context['compress_threads'])
+
+    # zip logs
+    if os.path.isdir(context['log_path']):
+        # TODO - currently treat log path as only containing relevant log info. I need to develop a sort or filter method!
+        if wanted('logs.' + context['logs_format']):
+            log.info('Zipping logs %s', context['log_path'])
+            archive_shared(context, context['log_path'], os.path.join(upload_dir, 'logs.' + context['logs_format']),
+                           context['logs_format'])
+    elif wanted(os.path.basename(context['log_path'])):
+        shutil.copy2(context['log_path'], upload_dir)
+
+    # zip scripts
+    if os.path.isdir(context['scripts_path']):
+        if wanted('run_scripts.zip'):
+            log.info('Zipping scripts %s', context['scripts_path'])
+            archive_shared(context, context['scripts_path'], os.path.join(upload_dir, 'run_scripts.zip'))
+    elif wanted(os.path.basename(context['scripts_path'])):
+        shutil.copy2(context['scripts_path'], upload_dir)
+
+    # bundle the subject report with only the figures of this session
+    if only is None or any(name.endswith('.html.zip') for name in only):
+        parts = os.path.relpath(context['bidspath'], context['SRC']).split(os.sep)
+        zip_fmriprep_report(context['SRC'], parts[0], upload_dir, session=parts[1] if len(parts) > 1 else None,
+                            policy=context['compression_policy'])
+
+    # copy metadata files to upload directory
+    for name in ['analysis_configuration.txt', 'analysis_information.txt']:
+        if wanted(name):
+            shutil.copy2(os.path.join(context['SRC'], name), upload_dir)
+
+    # add directory description:
+    if wanted('data_tree.txt'):
+        data_tree(context['bidspath'], os.path.join(upload_dir, 'data_tree.txt'))
+
+    # record names, sizes and digests of everything attached to the analysis
+    if only is not None:
+        return build_manifest(upload_dir)
+    return write_manifest(upload_dir)
+
+
+def sync_analysis(context, fw_container, manifest, upload_dir):
+    """Find the latest matching analysis and list the local files it is missing.
+
+    Returns:
+        (tuple): (analysis, names of files to upload), analysis is None if
+            no matching analysis exists yet
+    """
+    analysis = latest_analysis(fw_container, UPLOAD_LABEL)
+    if analysis is None:
+        log.info('No "%s" analysis to sync in container %s, creating a new one', UPLOAD_LABEL, fw_container.id)
+        return None, None
+
+    # full analysis record carries the file listing
+    analysis = context['governor'].call(context['fw'].get_analysis, analysis.id)
+    remote_sizes = {f.name: f.size for f in analysis.files or []}
+
+    remote_manifest = {}
+    if MANIFEST_NAME in remote_sizes:
+        remote_manifest_file = os.path.join(upload_dir, 'remote_' + MANIFEST_NAME)
+        context['governor'].transfer(analysis.download_file, MANIFEST_NAME, remote_manifest_file)
+        remote_manifest = read_manifest(remote_manifest_file)
+        os.remove(remote_manifest_file)
+
+    changed = files_to_sync(manifest, remote_sizes, remote_manifest,
+                            manifest_size=os.path.getsize(os.path.join(upload_dir, MANIFEST_NAME)))
+    log.info('Syncing analysis %s: %d of %d files missing or different', analysis.id, len(changed), len(manifest))
+    return analysis, changed
 
-        # zip scripts
-        log.info('Zipping scripts %s', context['scripts_path'])
-        if os.path.isdir(context['scripts_path']):
-            relpath = os.path.relpath(context['scripts_path'], context['SRC'])
-            zip_output(context['SRC'], relpath, os.path.join(context['SRC'], 'tmp_upload', 'run_scripts.zip'))
-        else:
-            os.system('cp ' + context['scripts_path'] + ' ' + os.path.join(context['SRC'], 'tmp_upload'))
 
-        # TODO Zip REPORT FILE!!
-        
-        # copy metadata files to upload directory
-        os.system(
-            'cp ' + os.path.join(context['SRC'], 'analysis_configuration.txt') + ' ' + os.path.join(context['SRC'],
-                                                                                                    'tmp_upload'))
-        os.system('cp ' + os.path.join(context['SRC'], 'analysis_information.txt') + ' ' + os.path.join(context['SRC'],
-                                                                                                        'tmp_upload'))
+def upload_analysis(context):
+    """Build and upload the analysis files of one subject or session, return True on success."""
+    fw_container = get_container(context)
+    upload_dir = os.path.join(context['SRC'], 'tmp_upload',
+                              os.path.relpath(context['bidspath'], context['SRC']).replace(os.sep, '_'))
+
+    try:
+        # create temporary upload location
+        os.makedirs(upload_dir, exist_ok=True)
+
+        manifest = build_uploads(context, upload_dir)
 
-        # add directory description:
-        data_tree(context['bidspath'], os.path.join(context['SRC'], 'tmp_upload/data_tree.txt'))
+        analysis = filenames = None
+        if context['sync']:
+            analysis, filenames = sync_analysis(context, fw_container, manifest, upload_dir)
 
-        # create an analysis for that session
-        analysis = fw_container.add_analysis(label='bids-fmriprep: Upload ' + dt.now().strftime(" %x %X"))
-        log.info('Creating %s analysis %s', context['run_level'], 'bids-fmriprep ' + dt.now().strftime(" %x %X"))
+        if analysis is None:
+            # create an analysis for that session
+            analysis = create_analysis(context, fw_container, UPLOAD_LABEL + ' ' + dt.now().strftime(" %x %X"))
+            log.info('Creating %s analysis %s', context['run_level'], 'bids-fmriprep ' + dt.now().strftime(" %x %X"))
+            filenames = sorted(os.listdir(upload_dir))
+
+        # record what the analysis should hold before sending anything, so an upload
+        # failing partway is still checked (and re-queued) by verify_batch()
+        record_upload(context, analysis, manifest, upload_dir)
 
         # log size of uploads
-        duResults = sp.Popen(
-            "du -hs " + os.path.join(context['SRC'], 'tmp_upload'), shell=True, stdout=sp.PIPE, stderr=sp.PIPE,
-            universal_newlines=True
-        )
-        stdout, _ = duResults.communicate()
-        log.info("\n %s", stdout)
+        upload_bytes = sum(os.path.getsize(os.path.join(upload_dir, f)) for f in filenames)
+        log.info('Uploading %d files (%s)', len(filenames), human_size(upload_bytes))
 
         # loop through all files to upload
-        for filename in sorted(os.listdir(os.path.join(context['SRC'], 'tmp_upload'))):
-            file_out = os.path.join(context['SRC'], 'tmp_upload', filename)
+        for filename in filenames:
+            file_out = os.path.join(upload_dir, filename)
 
             # checking if it is a file
             if os.path.isfile(file_out):
                 log.info('Uploading %s', file_out)
                 # upload output file to analysis container
-                analysis.upload_output(file_out)
-
-        # check upload!
-        check_upload_size(analysis, os.path.join(context['SRC'], 'tmp_upload'))
+                context['governor'].transfer(analysis.upload_output, file_out)
     except Exception as e:
         log.error(e)
+        return False
     finally:
-        os.system('rm -Rf ' + os.path.join(context['SRC'], 'tmp_upload'))
+        shutil.rmtree(upload_dir, ignore_errors=True)
+        try:
+            os.rmdir(os.path.dirname(upload_dir))
+        except OSError:
+            pass  # other sessions are still uploading
+
+    return True
 
 
 def data_tree(startpath, filename):
-    file = open(filename, "w")
-
-    for root, dirs, files in os.walk(startpath):
-        level = root.replace(startpath, '').count(os.sep)
-        indent = ' ' * 4 * (level - 1)
-        file.write('{}{}/\n'.format(indent, os.path.basename(root)))
-        subindent = ' ' * 4 * (level) + '|----'
-        for f in files:
-            duResults = sp.Popen(
-                "du -hs " + os.path.join(root, f), shell=True, stdout=sp.PIPE, stderr=sp.PIPE,
-                universal_newlines=True
-            )
-            stdout, _ = duResults.communicate()
-            flsize = stdout.split('\t')[0]
-            if not f == 'data_tree.txt':
-                file.write('{}{}\t{}\n'.format(subindent, f, flsize))
-
-    duResults = sp.Popen(
-        "du -hs " + startpath, shell=True, stdout=sp.PIPE, stderr=sp.PIPE,
-        universal_newlines=True
-    )
-    stdout, _ = duResults.communicate()
-    flsize = stdout.split('\t')[0]
-    file.write('{} {}\n'.format('Total Directory Size: ', flsize))
-    file.close()
+    """Write an indented listing of startpath with du-style sizes to filename.
+
+    Uses the shared walk_tree generator, so memory stays proportional to
+    tree depth, and sizes come from cached DirEntry stats rather than one
+    du process per file.
+    """
+    total = os.stat(startpath).st_blocks * 512
+
+    with open(filename, "w") as file:
+        file.write('{}/\n'.format(os.path.basename(startpath)))
+        for relpath, entry, depth in walk_tree(startpath):
+            size = disk_usage(entry)
+            total += size
+            if entry.is_dir(follow_symlinks=False):
+                file.write('{}{}/\n'.format(' ' * 4 * (depth - 1), entry.name))
+            elif not entry.name == 'data_tree.txt':
+                file.write('{}|----{}\t{}\n'.format(' ' * 4 * (depth - 1), entry.name, human_size(size)))
+
+        file.write('{} {}\n'.format('Total Directory Size: ', human_size(total)))
+
+
+def record_upload(context, analysis, manifest, upload_dir):
+    """Add the expected names and sizes of an uploaded analysis to the batch's upload record.
+
+    The flywheel labels and the manifest are recorded too, so that
+    repair_analysis can fix the analysis without looking it up again or
+    rebuilding files that arrived intact.
+    """
+    files = {name: entry['size'] for name, entry in manifest.items()}
+    files[MANIFEST_NAME] = os.path.getsize(os.path.join(upload_dir, MANIFEST_NAME))
+    context['upload_record'].add(analysis.id, files, manifest=manifest, run_level=context['run_level'],
+                                 subject=context['subject'], session=context['session'],
+                                 bidspath=os.path.relpath(context['bidspath'], context['SRC']))
+
+
+def list_analysis_files(context, analysis_id):
+    """Return {name: size} of the files of an analysis with a single API call."""
+    analysis = context['governor'].call(context['fw'].get_analysis, analysis_id)
+    return {f.name: f.size for f in analysis.files or []}
+
+
+def requeue_context(context, entry):
+    """Return a copy of the run context the recorded analysis was uploaded with."""
+    # records written before the labels were stored only have the directory names
+    parts = entry['bidspath'].split(os.sep)
+    ses_context = dict(context)
+    ses_context.update(subject=entry.get('subject', parts[0]),
+                       session=entry.get('session', parts[1] if len(parts) > 1 else None),
+                       run_level=entry['run_level'], bidspath=os.path.join(context['SRC'], entry['bidspath']))
+    return ses_context
+
+
+def repair_analysis(context, entry, names):
+    """Rebuild and upload only the named files of a recorded analysis, return True on success.
+
+    The analysis is fetched by its recorded id. Files that are not named
+    keep the digests of the recorded manifest, so e.g. a missing log
+    archive is sent again without rebuilding the derivative archive. The
+    manifest is uploaded too if it is named or a rebuilt file changed.
+    Records without a manifest rebuild every file but still only upload
+    the named ones.
+
+    Args:
+        context (dict): run context of the analysis, see requeue_context
+        entry (dict): UploadRecord entry of the analysis
+        names (list): files missing or different remotely
+    """
+    upload_dir = os.path.join(context['SRC'], 'tmp_upload', 'repair_' + entry['analysis'])
+    try:
+        analysis = context['governor'].call(context['fw'].get_analysis, entry['analysis'])
+        os.makedirs(upload_dir, exist_ok=True)
+
+        recorded = entry.get('manifest')
+        if recorded is None:
+            manifest = build_uploads(context, upload_dir)
+        else:
+            manifest = dict(recorded, **build_uploads(context, upload_dir, only=set(names)))
+            write_manifest(upload_dir, manifest)
+
+        filenames = [name for name in sorted(names) if name != MANIFEST_NAME]
+        if MANIFEST_NAME in names or manifest != recorded:
+            filenames.append(MANIFEST_NAME)
+        record_upload(context, analysis, manifest, upload_dir)
+
+        for filename in filenames:
+            file_out = os.path.join(upload_dir, filename)
+            if not os.path.isfile(file_out):
+                log.warning('Unable to rebuild %s for analysis %s', filename, analysis.id)
+                continue
+            log.info('Uploading %s', file_out)
+            context['governor'].transfer(analysis.upload_output, file_out)
+    except Exception as e:
+        log.error(e)
+        return False
+    finally:
+        shutil.rmtree(upload_dir, ignore_errors=True)
+        try:
+            os.rmdir(os.path.dirname(upload_dir))
+        except OSError:
+            pass  # other sessions are still uploading
 
+    return True
 
-def check_upload_size(analysis_container, source_dir):
-    log.info("Function under active development. Come back later!!")
+
+def verify_batch(context, given_up=None):
+    """Check every analysis uploaded in this batch, re-upload mismatches and write one report.
+
+    Each analysis is listed with a single get_analysis call (through the
+    shared governor) instead of one request per file. For analyses with
+    missing or different files only those files are rebuilt and uploaded
+    again (see repair_analysis), then the analyses are checked once more.
+
+    Args:
+        context (dict): run context
+        given_up (list, optional): watch mode sessions given up, listed in the report
+
+    Returns:
+        (dict): the verification report (see utils.verify.write_report)
+    """
+    record = context['upload_record']
+    list_files = partial(list_analysis_files, context)
+    workers = context['api_concurrency']
+
+    log.info('Verifying %d uploaded analyses', len(record.entries))
+    results = verify_uploads(record.entries.values(), list_files, workers=workers)
+
+    requeued = {analysis_id: result for analysis_id, result in results.items() if not result['ok']}
+    for analysis_id in sorted(requeued):
+        entry = record.entries[analysis_id]
+        names = requeued[analysis_id]['missing'] + sorted(requeued[analysis_id]['size_mismatch'])
+        log.warning('Analysis %s (%s) is missing %d files and has %d size mismatches, uploading %s again',
+                    analysis_id, entry['bidspath'], len(requeued[analysis_id]['missing']),
+                    len(requeued[analysis_id]['size_mismatch']), ', '.join(names))
+        repair_analysis(requeue_context(context, entry), entry, names)
+
+    if requeued:
+        results.update(verify_uploads([record.entries[a] for a in requeued], list_files, workers=workers))
+
+    report = write_report(context['verify_report'], record, results, requeued, given_up)
+    log.info('Verified %d of %d analyses (%d uploaded again), report written to %s',
+             report['verified'], report['analyses'], report['requeued'], context['verify_report'])
+    for analysis_id in report['failed']:
+        log.error('Analysis %s failed verification', analysis_id)
+    return report
 
 
 def check_checksum(analysis_container, source_dir):
@@ -336,15 +1011,9 @@ def cleanup():
 # Only execute if file is run as main, not when imported by another module
 if __name__ == "__main__":  # pragma: no cover
 
+    # the flywheel client is created by parser() once the arguments are valid
     pycontext = dict()
 
-    # Create client, using CLI credentials
-    pycontext['fw'] = flywheel.Client()
-
-    # who am I logged in as?
-    log.info('You are now logged in as %s to %s', pycontext['fw'].get_current_user()['email'],
-             pycontext['fw'].get_config()['site']['api_url'])
-
     main(pycontext)
     # 1. parse inputs (perform necessary checks, eg path exists, sub / ses exist)
 
@@ -1,20 +1,12 @@
 #!/bin/python
 
 from pathlib import Path
-import sys, subprocess, os, nipype, datetime, logging
+import sys, subprocess, os, datetime, logging
 
-sys.path.append('/projects/ics/software/flywheel-python/bids-client/')
-sys.path.append('/projects/ics/software/flywheel-python/')
 from getpass import getpass
-import flywheel, flywheel_gear_toolkit
-from flywheel_gear_toolkit.interfaces.command_line import (
-    build_command_list,
-    exec_command,
-)
-from flywheel_gear_toolkit.utils.zip_tools import unzip_archive, zip_output
-from utils.zip_htmls import zip_htmls
-from flywheel_bids.export_bids import export_bids
-from flywheel_bids.export_bids import download_bids_dir
+from functools import partial
+from utils.archive import DEFAULT_COMPRESSION_POLICY, zip_output
+from utils.archive_cache import cached_archive
 import subprocess as sp
 from datetime import datetime
 
@@ -74,16 +66,19 @@ def upload_zip_analysis(session_object, root_dir, source_dir):
     if run_upload:
         # zip output except for scratch
         log.info('Zipping contents of directory %s', root_dir + '/' + source_dir + '/' + subject + '/' + session)
-        zip_output(root_dir, source_dir + '/' + subject + '/' + session, "fw_uploads/pipeline_outputs.zip",
+        zip_output(root_dir, source_dir + '/' + subject + '/' + session, root_dir + "/fw_uploads/pipeline_outputs.zip",
                    exclude_files=['scratch'])
 
         # zip logs
         log.info('Zipping logs %s', root_dir + '/' + source_dir + '/' + subject + '/' + session)
-        zip_output(root_dir, source_dir + '/logs/' + subject, "fw_uploads/pipeline_logs.zip", exclude_files=['scratch'])
+        cached_archive(root_dir, source_dir + '/logs/' + subject, root_dir + "/fw_uploads/pipeline_logs.zip",
+                       partial(zip_output, exclude_files=['scratch']), exclude_files=['scratch'],
+                       extra=repr(DEFAULT_COMPRESSION_POLICY))
 
-        # zip scripts (same for all sessions)
-        if not os.path.exists(root_dir + '/fw_uploads/run_scripts.zip'):
-            zip_output(root_dir, "scripts/flywheel_scripts", "fw_uploads/run_scripts.zip", exclude_files=['scratch'])
+        # zip scripts (same for all sessions, compressed once and reused from the archive cache)
+        cached_archive(root_dir, "scripts/flywheel_scripts", root_dir + "/fw_uploads/run_scripts.zip",
+                       partial(zip_output, exclude_files=['scratch']), exclude_files=['scratch'],
+                       extra=repr(DEFAULT_COMPRESSION_POLICY))
 
         # create an analysis for that session
         timestamp = os.path.getmtime(root_dir + '/' + source_dir + '/' + subject + '/' + session)
@@ -133,6 +128,11 @@ if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
     log = logging.getLogger('root')
 
+    # flywheel sdk is loaded only when running uploads (slow to import on nfs)
+    sys.path.append('/projects/ics/software/flywheel-python/bids-client/')
+    sys.path.append('/projects/ics/software/flywheel-python/')
+    import flywheel
+
     # Create client, using CLI credentials
     fw = flywheel.Client()
 
@@ -0,0 +1,111 @@
+# unit tests for archive builds...
+import hashlib
+import io
+import json
+import os
+import shutil
+import subprocess as sp
+import tarfile
+import zipfile
+
+import pytest
+
+from utils.archive import ARCHIVE_MANIFEST, compression_for, load_compression_policy, tar_output, zip_output
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def test_compression_policy_by_type(tmp_path):
+    _write(str(tmp_path / "bold.nii.gz"), b"\x1f\x8b" + os.urandom(1024))
+    _write(str(tmp_path / "confounds.tsv"), b"a\tb\n" * 100)
+    _write(str(tmp_path / "noise.bin"), os.urandom(4096))
+    _write(str(tmp_path / "text.bin"), b"hello world " * 500)
+
+    assert compression_for(str(tmp_path / "bold.nii.gz"))[0] == zipfile.ZIP_STORED
+    assert compression_for(str(tmp_path / "confounds.tsv"))[0] == zipfile.ZIP_DEFLATED
+    assert compression_for(str(tmp_path / "noise.bin"))[0] == zipfile.ZIP_STORED
+    assert compression_for(str(tmp_path / "text.bin"))[0] == zipfile.ZIP_DEFLATED
+
+
+def test_load_compression_policy(tmp_path):
+    policy_file = tmp_path / "policy.json"
+    policy_file.write_text(json.dumps({"*.tsv": "stored", "*.dat": "deflate:9"}))
+    policy = load_compression_policy(str(policy_file))
+
+    _write(str(tmp_path / "confounds.tsv"), b"a\tb\n" * 100)
+    _write(str(tmp_path / "x.dat"), os.urandom(64))
+    assert compression_for(str(tmp_path / "confounds.tsv"), policy) == (zipfile.ZIP_STORED, None)
+    assert compression_for(str(tmp_path / "x.dat"), policy) == (zipfile.ZIP_DEFLATED, 9)
+
+
+@pytest.mark.parametrize("rules", [{"*.tsv": "deflate:12"}, {"*.tsv": "deflate:x"}, {"*.tsv": "stored:5"},
+                                   {"*.tsv": "bzip2"}, ["*.tsv", "stored"]])
+def test_load_compression_policy_invalid(tmp_path, rules):
+    policy_file = tmp_path / "policy.json"
+    policy_file.write_text(json.dumps(rules))
+    with pytest.raises(ValueError):
+        load_compression_policy(str(policy_file))
+
+
+def test_zip_output(tmp_path):
+    _write(str(tmp_path / "sub-01" / "ses-01" / "func" / "bold.nii.gz"), os.urandom(1024))
+    _write(str(tmp_path / "sub-01" / "ses-01" / "func" / "confounds.tsv"), b"a\tb\n" * 100)
+    _write(str(tmp_path / "sub-01" / "ses-01" / "scratch" / "tmp.txt"), b"junk")
+    out = str(tmp_path / "out.zip")
+
+    cwd = os.getcwd()
+    zip_output(str(tmp_path), "sub-01/ses-01", out, exclude_files=["scratch"])
+    assert os.getcwd() == cwd
+
+    with zipfile.ZipFile(out) as zf:
+        members = {i.filename: i.compress_type for i in zf.infolist()}
+    assert members["sub-01/ses-01/func/bold.nii.gz"] == zipfile.ZIP_STORED
+    assert members["sub-01/ses-01/func/confounds.tsv"] == zipfile.ZIP_DEFLATED
+    assert not any("scratch" in m for m in members)
+
+
+def test_zip_output_reproducible(tmp_path):
+    for name in ["b.tsv", "a.json", "c.nii.gz"]:
+        _write(str(tmp_path / "src" / name), name.encode() * 100)
+
+    zip_output(str(tmp_path), "src", str(tmp_path / "one.zip"))
+    zip_output(str(tmp_path), "src", str(tmp_path / "two.zip"))
+    assert (tmp_path / "one.zip").read_bytes() == (tmp_path / "two.zip").read_bytes()
+
+
+def test_zip_output_symlinked_dir(tmp_path):
+    _write(str(tmp_path / "other" / "x.tsv"), b"a\tb\n")
+    _write(str(tmp_path / "src" / "a.tsv"), b"a\tb\n")
+    os.symlink(os.path.join("..", "other"), str(tmp_path / "src" / "linkdir"))
+
+    zip_output(str(tmp_path), "src", str(tmp_path / "out.zip"))
+    with zipfile.ZipFile(str(tmp_path / "out.zip")) as zf:
+        assert sorted(zf.namelist()) == ["src/a.tsv", "src/linkdir/"]
+
+
+@pytest.mark.parametrize("fmt", ["tar.gz", pytest.param("tar.zst", marks=pytest.mark.skipif(
+    not shutil.which("zstd"), reason="zstd command not available"))])
+def test_tar_output(tmp_path, fmt):
+    _write(str(tmp_path / "logs" / "sub-01.log"), b"fMRIPrep finished successfully!\n" * 100)
+    _write(str(tmp_path / "logs" / "scratch" / "tmp.txt"), b"junk")
+    out = str(tmp_path / ("logs." + fmt))
+
+    tar_output(str(tmp_path), "logs", out, exclude_files=["scratch"], fmt=fmt, threads=2)
+
+    if fmt == "tar.zst":
+        data = sp.run(["zstd", "-dc", out], stdout=sp.PIPE, check=True).stdout
+        tar = tarfile.open(fileobj=io.BytesIO(data))
+    else:
+        tar = tarfile.open(out)
+    with tar:
+        names = tar.getnames()
+        manifest = json.load(tar.extractfile(ARCHIVE_MANIFEST))
+        log_data = tar.extractfile("logs/sub-01.log").read()
+
+    assert "logs/scratch/tmp.txt" not in names
+    assert manifest["members"]["logs/sub-01.log"] == {
+        "size": len(log_data), "sha256": hashlib.sha256(log_data).hexdigest()}
@@ -0,0 +1,71 @@
+# unit tests for the content-addressed archive cache...
+import os
+
+from utils.archive import zip_output
+from utils.archive_cache import cached_archive, evict_archive_cache
+
+
+def test_cached_archive(tmp_path):
+    scripts = tmp_path / "src" / "scripts"
+    scripts.mkdir(parents=True)
+    (scripts / "run_script.sh").write_text("echo hello\n")
+    cache_dir = str(tmp_path / "cache")
+
+    builds = []
+
+    def build(root_dir, source_dir, path):
+        builds.append(source_dir)
+        zip_output(root_dir, source_dir, path)
+
+    out1 = str(tmp_path / "ses-01" / "run_scripts.zip")
+    out2 = str(tmp_path / "ses-02" / "run_scripts.zip")
+    os.makedirs(os.path.dirname(out1))
+    os.makedirs(os.path.dirname(out2))
+
+    assert not cached_archive(str(tmp_path / "src"), "scripts", out1, build, cache_dir=cache_dir)
+    assert cached_archive(str(tmp_path / "src"), "scripts", out2, build, cache_dir=cache_dir)
+    assert len(builds) == 1
+    assert open(out1, "rb").read() == open(out2, "rb").read()
+
+    # changed inputs are a cache miss
+    (scripts / "run_script.sh").write_text("echo hello world\n")
+    assert not cached_archive(str(tmp_path / "src"), "scripts", out2, build, cache_dir=cache_dir)
+    assert len(builds) == 2
+
+
+def test_evict_archive_cache(tmp_path):
+    for i, name in enumerate(["old.zip", "mid.zip", "new.zip"]):
+        path = tmp_path / name
+        path.write_bytes(b"x" * 100)
+        os.utime(str(path), (i, i))
+
+    evict_archive_cache(str(tmp_path), max_bytes=200)
+    assert sorted(os.listdir(str(tmp_path))) == ["mid.zip", "new.zip"]
+
+
+def test_cached_archive_evicted_concurrently(tmp_path, monkeypatch):
+    scripts = tmp_path / "src" / "scripts"
+    scripts.mkdir(parents=True)
+    (scripts / "run_script.sh").write_text("echo hello\n")
+    cache_dir = str(tmp_path / "cache")
+    out = str(tmp_path / "run_scripts.zip")
+    builds = []
+
+    def build(root_dir, source_dir, path):
+        builds.append(source_dir)
+        zip_output(root_dir, source_dir, path)
+
+    cached_archive(str(tmp_path / "src"), "scripts", out, build, cache_dir=cache_dir)
+
+    # another job array task evicts the entry between the existence check and the link
+    link = os.link
+
+    def evicting_link(source, dest):
+        if source.startswith(cache_dir) and not source.endswith(".tmp"):
+            os.remove(source)
+        link(source, dest)
+
+    monkeypatch.setattr(os, "link", evicting_link)
+    assert not cached_archive(str(tmp_path / "src"), "scripts", out, build, cache_dir=cache_dir)
+    assert len(builds) == 2
+    assert os.path.getsize(out) > 0
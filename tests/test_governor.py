@@ -0,0 +1,126 @@
+# unit tests for the flywheel request governor...
+import threading
+import time
+
+import pytest
+
+from utils.governor import RequestGovernor, is_retryable
+
+
+class ApiException(Exception):
+    def __init__(self, status):
+        super().__init__(status)
+        self.status = status
+
+
+def test_governor_caps_in_flight():
+    gov = RequestGovernor(max_concurrency=3)
+    gov.limit = 3.0
+
+    def slow():
+        time.sleep(0.05)
+
+    threads = [threading.Thread(target=gov.call, args=(slow,)) for _ in range(10)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    stats = gov.stats()
+    assert stats["requests"] == 10
+    assert stats["max_in_flight"] <= 3
+    assert stats["in_flight"] == 0
+
+
+def test_transfers_do_not_starve_metadata_calls():
+    gov = RequestGovernor(max_concurrency=1, max_transfers=2, latency_target=0.01)
+    started = threading.Semaphore(0)
+    release = threading.Event()
+
+    def upload():
+        started.release()
+        release.wait(5)
+
+    threads = [threading.Thread(target=gov.transfer, args=(upload,)) for _ in range(3)]
+    for t in threads:
+        t.start()
+    started.acquire()
+    started.acquire()
+
+    # both transfer slots are busy (the third waits), lookups still go through
+    assert gov.call(lambda: "found") == "found"
+    assert not started.acquire(timeout=0.1)
+    release.set()
+    for t in threads:
+        t.join()
+
+    stats = gov.stats()
+    assert stats["max_transfers"] == 2 and stats["transfers"] == 3
+    assert stats["requests"] == 1
+    # long transfers are not a congestion signal
+    assert stats["decreases"] == 0
+
+
+def test_governor_aimd():
+    gov = RequestGovernor(max_concurrency=16, retries=1, backoff=0)
+    start = gov.limit
+    for _ in range(20):
+        gov.call(lambda: None)
+    assert gov.limit > start
+
+    increased = gov.limit
+    calls = []
+
+    def throttled():
+        calls.append(1)
+        if len(calls) == 1:
+            raise ApiException(429)
+        return "ok"
+
+    assert gov.call(throttled) == "ok"
+    assert gov.limit == pytest.approx(increased / 2, abs=0.5)
+    stats = gov.stats()
+    assert stats["throttled"] == 1 and stats["retries"] == 1
+
+
+def test_governor_does_not_retry_client_errors():
+    gov = RequestGovernor(backoff=0)
+    start = gov.limit
+
+    def missing():
+        raise ApiException(404)
+
+    with pytest.raises(ApiException):
+        gov.call(missing)
+    assert gov.stats()["retries"] == 0
+    assert gov.limit >= start - 1
+
+
+def test_requests_connection_errors_are_retryable():
+    # requests' exceptions derive from IOError, not the builtin ConnectionError
+    class RequestException(IOError):
+        pass
+
+    class ConnectionError(RequestException):  # noqa: A001 - mirrors requests.exceptions
+        pass
+
+    class ReadTimeout(RequestException):
+        pass
+
+    assert is_retryable(ConnectionError("reset"))
+    assert is_retryable(ReadTimeout("timed out"))
+    assert not is_retryable(FileNotFoundError("missing.zip"))
+    assert not is_retryable(ApiException(404))
+
+
+def test_call_once_does_not_retry():
+    gov = RequestGovernor(retries=3, backoff=0)
+    calls = []
+
+    def create():
+        calls.append(1)
+        raise ApiException(502)
+
+    with pytest.raises(ApiException):
+        gov.call_once(create)
+    assert len(calls) == 1
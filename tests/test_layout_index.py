@@ -0,0 +1,98 @@
+# unit tests for the persistent layout index...
+import logging
+import os
+import sqlite3
+
+from fmriprep_upload import known_labels, log_selection
+from utils.layout_index import LayoutIndex, entities, with_prefix
+
+
+def _write(path, nbytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(b"x" * nbytes)
+
+
+def test_labels():
+    assert with_prefix("sub-01", "sub-") == "sub-01"
+    assert with_prefix("bus01", "sub-") == "sub-bus01"
+    assert entities(os.path.join("sub-01", "ses-02", "func", "bold.nii.gz")) == ("sub-01", "ses-02")
+    assert entities(os.path.join("sub-01", "figures", "sub-01_ses-03_bold.svg")) == ("sub-01", "ses-03")
+    assert entities(os.path.join("sub-01", "anat", "sub-01_T1w.nii.gz")) == ("sub-01", None)
+
+
+def test_layout_index_refresh(tmp_path):
+    src = tmp_path / "fmriprep"
+    _write(str(src / "sub-01" / "ses-01" / "func" / "bold.nii.gz"), 100)
+    _write(str(src / "sub-01" / "ses-02" / "func" / "bold.nii.gz"), 50)
+    _write(str(src / "sub-01" / "figures" / "sub-01_ses-01_bold.svg"), 10)
+    _write(str(src / "sub-02" / "ses-01" / "anat" / "T1w.nii.gz"), 7)
+    index_path = str(tmp_path / "index.sqlite")
+
+    index = LayoutIndex(str(src), index_path)
+    assert index.refresh() > 0
+    assert index.subjects() == ["sub-01", "sub-02"]
+    assert index.sessions() == [("sub-01", "ses-01"), ("sub-01", "ses-02"), ("sub-02", "ses-01")]
+    assert index.session_bytes()[("sub-01", "ses-01")] == 110
+    assert len(index.files("sub-01", "ses-01")) == 2
+    assert index.refresh() == 0
+    index.close()
+
+    # a new index on the same file only re-lists changed directories
+    _write(str(src / "sub-02" / "ses-01" / "anat" / "T2w.nii.gz"), 3)
+    os.rename(str(src / "sub-01" / "ses-02"), str(src / "sub-01" / "ses-03"))
+    index = LayoutIndex(str(src), index_path)
+    assert index.refresh() == 4  # sub-02/ses-01/anat, sub-01, new sub-01/ses-03 and its func/
+    assert index.sessions() == [("sub-01", "ses-01"), ("sub-01", "ses-03"), ("sub-02", "ses-01")]
+    assert index.session_bytes()[("sub-02", "ses-01")] == 10
+    assert index.files("sub-01", "ses-02") == []
+
+
+def test_locked_index_is_not_fatal(tmp_path, caplog):
+    caplog.set_level(logging.INFO)
+    _write(str(tmp_path / "src" / "sub-01" / "ses-01" / "anat" / "T1w.nii.gz"), 10)
+    index_path = str(tmp_path / "index.sqlite")
+    index = LayoutIndex(str(tmp_path / "src"), index_path, timeout=0.1)
+
+    # another job array task holding the write lock
+    other = sqlite3.connect(index_path)
+    other.execute("BEGIN EXCLUSIVE")
+    try:
+        log_selection({"layout": index, "layout_index": index_path}, os.path.join("sub-01", "ses-01"))
+    finally:
+        other.rollback()
+        other.close()
+    assert "unavailable" in caplog.text
+
+    log_selection({"layout": index, "layout_index": index_path}, os.path.join("sub-01", "ses-01"))
+    assert "1 files" in caplog.text
+
+
+def test_index_in_working_directory(tmp_path, monkeypatch):
+    _write(str(tmp_path / "src" / "sub-01" / "ses-01" / "anat" / "T1w.nii.gz"), 10)
+    monkeypatch.chdir(tmp_path)
+
+    # a bare file name (--layout-index idx.sqlite) has no directory to create
+    index = LayoutIndex("src", "idx.sqlite")
+    index.refresh()
+    assert os.path.isfile(str(tmp_path / "idx.sqlite"))
+
+
+def test_refresh_depth_and_known_labels(tmp_path):
+    src = tmp_path / "src"
+    _write(str(src / "sub-01" / "ses-01" / "anat" / "T1w.nii.gz"), 10)
+    _write(str(src / "sub-02" / "ses-01" / "anat" / "T1w.nii.gz"), 10)
+    index = LayoutIndex(str(src), str(tmp_path / "index.sqlite"))
+
+    # root, two subjects and their sessions, nothing below
+    assert index.refresh(depth=2) == 5
+    assert index.sessions() == [("sub-01", "ses-01"), ("sub-02", "ses-01")]
+    assert index.files("sub-01", "ses-01") == []
+    assert index.refresh(depth=2) == 0
+    assert index.refresh() == 2
+    assert len(index.files("sub-01", "ses-01")) == 1
+
+    context = {"layout": index, "SRC": str(src)}
+    assert known_labels(context, os.path.join("sub-01", "ses-02")) == " (sessions of sub-01: ses-01)"
+    assert known_labels(context, "sub-03") == " (subjects: sub-01, sub-02)"
+    assert known_labels({"layout": None}, "sub-03") == ""
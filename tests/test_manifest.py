@@ -0,0 +1,57 @@
+# unit tests for upload manifests and sync selection...
+from types import SimpleNamespace
+
+from utils.manifest import MANIFEST_NAME, files_to_sync, read_manifest, write_manifest
+from utils.utils import latest_analysis
+
+
+def test_write_manifest(tmp_path):
+    (tmp_path / "logs.zip").write_bytes(b"logs")
+    (tmp_path / "data_tree.txt").write_text("tree\n")
+
+    manifest = write_manifest(str(tmp_path))
+    assert sorted(manifest) == ["data_tree.txt", "logs.zip"]
+    assert manifest["logs.zip"]["size"] == 4
+    assert read_manifest(str(tmp_path / MANIFEST_NAME)) == manifest
+
+
+def test_files_to_sync():
+    local = {
+        "bids-fmriprep.zip": {"size": 10, "sha256": "a"},
+        "logs.zip": {"size": 5, "sha256": "b"},
+        "run_scripts.zip": {"size": 3, "sha256": "c"},
+        "data_tree.txt": {"size": 7, "sha256": "d"},
+    }
+    remote_sizes = {"bids-fmriprep.zip": 10, "logs.zip": 4, "data_tree.txt": 7}
+    remote_manifest = {"data_tree.txt": {"size": 7, "sha256": "old"}}
+
+    assert files_to_sync(local, remote_sizes, remote_manifest) == ["data_tree.txt", "logs.zip", "run_scripts.zip"]
+    assert files_to_sync(local, remote_sizes) == ["logs.zip", "run_scripts.zip"]
+
+
+def test_latest_analysis_skips_gear_runs():
+    analyses = [
+        SimpleNamespace(label="bids-fmriprep: Upload  01/01/24 10:00:00", created=1, job=None),
+        SimpleNamespace(label="bids-fmriprep: Upload  01/02/24 10:00:00", created=2, job=None),
+        SimpleNamespace(label="fmriprep 01/03/24", created=3, job=SimpleNamespace(state="complete")),
+        SimpleNamespace(label="bids-fmriprep: Upload (failed job)", created=4, job=SimpleNamespace(state="failed")),
+    ]
+    container = SimpleNamespace(analyses=analyses)
+
+    assert latest_analysis(container, "bids-fmriprep: Upload").created == 2
+    assert latest_analysis(SimpleNamespace(analyses=analyses[2:]), "bids-fmriprep: Upload") is None
+
+
+def test_files_to_sync_manifest_only_missing():
+    local = {"logs.zip": {"size": 5, "sha256": "b"}, "data_tree.txt": {"size": 7, "sha256": "d"}}
+
+    # an upload that stopped just before the manifest (always sent last)
+    remote_sizes = {"logs.zip": 5, "data_tree.txt": 7}
+    assert files_to_sync(local, remote_sizes, manifest_size=120) == [MANIFEST_NAME]
+
+    remote_sizes[MANIFEST_NAME] = 100
+    assert files_to_sync(local, remote_sizes, manifest_size=120) == [MANIFEST_NAME]
+
+    remote_sizes[MANIFEST_NAME] = 120
+    assert files_to_sync(local, remote_sizes, manifest_size=120) == []
+    assert files_to_sync(local, dict(remote_sizes, **{"logs.zip": 4}), manifest_size=120) == ["logs.zip", MANIFEST_NAME]
@@ -0,0 +1,68 @@
+# unit tests for fmriprep report bundling...
+import os
+import time
+import zipfile
+
+import pytest
+
+pytest.importorskip("bs4")
+
+from utils.utils import zip_fmriprep_report  # noqa: E402
+
+REPORT = """<html><body>
+<div id="datatype-figures_suffix-T1w"><img src="./sub-01/figures/sub-01_desc-reconall_T1w.svg"></div>
+<div id="datatype-figures_session-01_suffix-bold">
+  <h3>Reports for session 01</h3>
+  <img src="./sub-01/figures/sub-01_ses-01_desc-summary_bold.svg">
+</div>
+<div id="datatype-figures_session-02_suffix-bold">
+  <h3>Reports for session 02</h3>
+  <img src="./sub-01/figures/sub-01_ses-02_desc-summary_bold.svg">
+  <object data="./sub-01/figures/sub-01_ses-02_desc-carpetplot_bold.svg"></object>
+</div>
+<a href="https://fmriprep.org">fmriprep</a><a href="#about">about</a>
+</body></html>
+"""
+
+
+def test_zip_fmriprep_report(tmp_path):
+    figures = tmp_path / "sub-01" / "figures"
+    figures.mkdir(parents=True)
+    for name in ["sub-01_desc-reconall_T1w.svg", "sub-01_ses-01_desc-summary_bold.svg",
+                 "sub-01_ses-02_desc-summary_bold.svg", "sub-01_ses-02_desc-carpetplot_bold.svg"]:
+        (figures / name).write_text("<svg/>")
+    (tmp_path / "sub-01.html").write_text(REPORT)
+    out = tmp_path / "out"
+    out.mkdir()
+
+    dest = zip_fmriprep_report(str(tmp_path), "sub-01", str(out), session="ses-01")
+    assert os.path.basename(dest) == "sub-01_ses-01.html.zip"
+
+    with zipfile.ZipFile(dest) as zf:
+        names = sorted(zf.namelist())
+        html = zf.read("index.html").decode()
+    assert names == ["index.html", "sub-01/figures/sub-01_desc-reconall_T1w.svg",
+                     "sub-01/figures/sub-01_ses-01_desc-summary_bold.svg"]
+    assert "session 02" not in html
+    assert 'src="sub-01/figures/sub-01_ses-01_desc-summary_bold.svg"' in html
+    assert "https://fmriprep.org" in html
+
+
+def test_zip_fmriprep_report_missing(tmp_path):
+    assert zip_fmriprep_report(str(tmp_path), "sub-01", str(tmp_path), session="ses-01") is None
+
+
+def test_zip_fmriprep_report_reproducible(tmp_path, monkeypatch):
+    (tmp_path / "sub-01.html").write_text("<html><body>report</body></html>")
+    old = 1600000000
+    os.utime(str(tmp_path / "sub-01.html"), (old, old))
+
+    with open(zip_fmriprep_report(str(tmp_path), "sub-01", str(tmp_path), session="ses-01"), "rb") as f:
+        first = f.read()
+    # a later build of the unchanged report is byte-identical
+    monkeypatch.setattr(zipfile.time, "time", lambda: old + 3600 * 24)
+    dest = zip_fmriprep_report(str(tmp_path), "sub-01", str(tmp_path), session="ses-01")
+    with open(dest, "rb") as f:
+        assert f.read() == first
+    with zipfile.ZipFile(dest) as zf:
+        assert zf.getinfo("index.html").date_time == time.localtime(old)[:6]
@@ -0,0 +1,54 @@
+# import-time budget for the command line tools...
+import os
+import subprocess as sp
+import sys
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DERIVS = os.path.join(REPO, "test_files", "fmriprep_derivs")
+
+# wall clock budget (seconds) for --help and argument validation, override on slow filesystems
+BUDGET = float(os.environ.get("STARTUP_BUDGET", "1.5"))
+
+# dependencies that must only be loaded on the code paths that need them
+HEAVY = {"flywheel", "flywheel_gear_toolkit", "flywheel_bids", "pandas", "numpy", "bs4", "nipype", "bids"}
+
+
+def _run(*args):
+    """Run a tool with -X importtime, return (returncode, seconds, imported top-level modules)."""
+    start = time.perf_counter()
+    result = sp.run([sys.executable, "-X", "importtime", *args], cwd=REPO, stdout=sp.PIPE, stderr=sp.PIPE,
+                    universal_newlines=True)
+    elapsed = time.perf_counter() - start
+
+    modules = set()
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            modules.add(line.rsplit("|", 1)[1].strip().split(".")[0])
+    return result.returncode, elapsed, modules
+
+
+def test_help_startup():
+    returncode, elapsed, modules = _run("fmriprep_upload.py", "--help")
+    assert returncode == 0
+    assert not modules & HEAVY
+    assert elapsed < BUDGET
+
+
+def test_argument_validation_startup():
+    returncode, elapsed, modules = _run("fmriprep_upload.py", DERIVS, "group", "project", "--session", "ses-S1")
+    assert returncode == 2
+    assert not modules & HEAVY
+    assert elapsed < BUDGET
+
+    returncode, elapsed, modules = _run("fmriprep_upload.py", DERIVS, "group", "project", "--subject", "sub-missing")
+    assert returncode == 2
+    assert not modules & HEAVY
+    assert elapsed < BUDGET
+
+
+def test_fmripreproc_import():
+    returncode, elapsed, modules = _run("-c", "import fmripreproc")
+    assert returncode == 0
+    assert not modules & HEAVY
+    assert elapsed < BUDGET
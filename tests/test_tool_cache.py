@@ -0,0 +1,67 @@
+# unit tests for cached tool introspection...
+import os
+import stat
+
+from fmriprep_upload import generate_analysis_config, generate_analysis_info
+from utils.tool_cache import cached_tool_help
+
+
+def test_cached_tool_help(tmp_path):
+    counter = tmp_path / "calls"
+    tool = tmp_path / "tool.sh"
+    tool.write_text("#!/bin/sh\necho run >> " + str(counter) + "\necho usage: tool\n")
+    tool.chmod(tool.stat().st_mode | stat.S_IEXEC)
+    cache_dir = str(tmp_path / "cache")
+
+    assert cached_tool_help(str(tool), cache_dir=cache_dir) == "usage: tool\n"
+    assert cached_tool_help(str(tool), cache_dir=cache_dir) == "usage: tool\n"
+    assert counter.read_text().count("run") == 1
+
+    # a modified tool invalidates the cache
+    tool.write_text(tool.read_text().replace("usage: tool", "usage: tool v2"))
+    os.utime(str(tool), ns=(0, tool.stat().st_mtime_ns + 10 ** 9))
+    assert cached_tool_help(str(tool), cache_dir=cache_dir) == "usage: tool v2\n"
+    assert counter.read_text().count("run") == 2
+
+
+def test_generate_analysis_info_empty_output(tmp_path):
+    tool = tmp_path / "broken.sh"
+    tool.write_text("#!/bin/sh\necho 'container error' >&2\nexit 1\n")
+    tool.chmod(tool.stat().st_mode | stat.S_IEXEC)
+    info_file = tmp_path / "analysis_information.txt"
+
+    assert not generate_analysis_info(str(tool), str(info_file), cache_dir=str(tmp_path / "cache"))
+    assert not info_file.exists()
+
+
+SAMPLE_LOG = """\
+Singularity> fmriprep /data /out participant --participant-label 10462 --fs-license-file /opt/license.txt
+211019-10:12:01,482 nipype.workflow IMPORTANT:
+\t Running fMRIPrep version 21.0.2:
+      * BIDS dataset path: /data.
+      * Participant list: ['10462'].
+      * Run identifier: 20211019-101148_6a0c1f1e.
+      * Output spaces: MNI152NLin2009cAsym:res-native.
+211019-10:12:03,120 nipype.workflow INFO:
+\t [Node] Setting-up "fmriprep_wf.single_subject_10462_wf.bidssrc"
+"""
+
+
+def test_generate_analysis_config(tmp_path):
+    logs = tmp_path / "logs"
+    logs.mkdir()
+    (logs / "sub-10462_fmriprep.log").write_text(SAMPLE_LOG)
+    (logs / "unrelated.log").write_text("nothing to see\n")
+    config_file = tmp_path / "analysis_configuration.txt"
+
+    assert generate_analysis_config(str(logs), str(config_file))
+    lines = config_file.read_text().splitlines()
+    assert lines[0] == "# sub-10462_fmriprep.log"
+    assert lines[1].startswith("Singularity> fmriprep /data /out participant --participant-label 10462")
+    assert "Running fMRIPrep version 21.0.2:" in lines
+    assert "    * Participant list: ['10462']." in lines
+    assert "    * Output spaces: MNI152NLin2009cAsym:res-native." in lines
+    assert not any("Setting-up" in line for line in lines)
+
+    (logs / "sub-10462_fmriprep.log").write_text("no configuration\n")
+    assert not generate_analysis_config(str(logs), str(config_file))
@@ -0,0 +1,136 @@
+# unit tests for batch upload verification...
+import json
+import os
+from types import SimpleNamespace
+
+import fmriprep_upload
+from utils.governor import RequestGovernor
+from utils.manifest import build_manifest, write_manifest
+from utils.verify import UploadRecord, compare_files, verify_uploads, write_report
+
+
+def test_compare_files():
+    expected = {"bids-fmriprep.zip": 10, "logs.zip": 5, "data_tree.txt": 7}
+    remote = {"bids-fmriprep.zip": 10, "logs.zip": 4, "old.txt": 1}
+
+    assert compare_files(expected, remote) == {"missing": ["data_tree.txt"], "size_mismatch": {"logs.zip": [5, 4]}}
+    assert compare_files(expected, dict(expected, extra=3)) == {"missing": [], "size_mismatch": {}}
+
+
+def test_record_roundtrip(tmp_path):
+    path = str(tmp_path / "record.jsonl")
+    record = UploadRecord(path)
+    record.add("a1", {"logs.zip": 5}, bidspath="sub-01/ses-01")
+    record.add("a2", {"logs.zip": 5}, bidspath="sub-01/ses-02")
+    record.add("a1", {"logs.zip": 6}, bidspath="sub-01/ses-01")
+
+    loaded = UploadRecord.load(path)
+    assert sorted(loaded.entries) == ["a1", "a2"]
+    assert loaded.entries["a1"]["files"] == {"logs.zip": 6}
+
+
+def test_verify_uploads_one_call_per_analysis(tmp_path):
+    record = UploadRecord()
+    record.add("a1", {"bids-fmriprep.zip": 10, "logs.zip": 5}, bidspath="sub-01/ses-01")
+    record.add("a2", {"bids-fmriprep.zip": 12, "logs.zip": 5}, bidspath="sub-02/ses-01")
+    record.add("a3", {"logs.zip": 5}, bidspath="sub-03/ses-01")
+
+    remote = {"a1": {"bids-fmriprep.zip": 10, "logs.zip": 5}, "a2": {"bids-fmriprep.zip": 12}}
+    calls = []
+
+    def list_files(analysis_id):
+        calls.append(analysis_id)
+        if analysis_id not in remote:
+            raise RuntimeError("not found")
+        return remote[analysis_id]
+
+    results = verify_uploads(record.entries.values(), list_files, workers=2)
+    assert sorted(calls) == ["a1", "a2", "a3"]
+    assert results["a1"]["ok"]
+    assert results["a2"]["missing"] == ["logs.zip"] and not results["a2"]["ok"]
+    assert results["a3"]["error"] == "not found" and not results["a3"]["ok"]
+
+    report_path = str(tmp_path / "report.json")
+    given_up = [{"subject": "sub-04", "session": "ses-01", "attempts": 5, "error": "connection dropped"}]
+    report = write_report(report_path, record, results, requeued={"a2": results["a2"]}, given_up=given_up)
+    assert report["analyses"] == 3
+    assert report["given_up"] == given_up
+    assert report["verified"] == 1
+    assert report["failed"] == ["a2", "a3"]
+    with open(report_path) as f:
+        assert json.load(f)["results"][1]["first_pass"]["missing"] == ["logs.zip"]
+
+
+def test_partial_upload_is_recorded(tmp_path, monkeypatch):
+    def build_uploads(context, upload_dir):
+        for name in ["a.zip", "b.zip", "c.zip"]:
+            with open(os.path.join(upload_dir, name), "w") as f:
+                f.write(name)
+        return write_manifest(upload_dir)
+
+    sent = []
+
+    class Analysis:
+        id = "a1"
+
+        def upload_output(self, path):
+            if len(sent) == 2:
+                raise RuntimeError("connection dropped")
+            sent.append(os.path.basename(path))
+
+    container = SimpleNamespace(id="c1", analyses=[], add_analysis=lambda label: Analysis())
+    monkeypatch.setattr(fmriprep_upload, "get_container", lambda context: container)
+    monkeypatch.setattr(fmriprep_upload, "build_uploads", build_uploads)
+
+    record = UploadRecord()
+    context = {"SRC": str(tmp_path), "bidspath": str(tmp_path / "sub-01" / "ses-01"), "sync": False,
+               "subject": "01", "session": "01", "run_level": "session", "governor": RequestGovernor(backoff=0), "upload_record": record}
+    assert not fmriprep_upload.upload_analysis(context)
+
+    # the half-filled analysis is still checked against every expected file
+    assert sorted(record.entries["a1"]["files"]) == ["a.zip", "b.zip", "c.zip", "upload_manifest.json"]
+    results = verify_uploads(record.entries.values(), lambda analysis_id: {name: 5 for name in sent})
+    assert results["a1"]["missing"] == ["c.zip", "upload_manifest.json"]
+
+
+def test_repair_rebuilds_only_mismatched_files(tmp_path, monkeypatch):
+    built = []
+
+    def build_uploads(context, upload_dir, only=None):
+        names = ["bids-fmriprep.zip", "logs.zip"] if only is None else sorted(only - {"upload_manifest.json"})
+        for name in names:
+            built.append(name)
+            with open(os.path.join(upload_dir, name), "w") as f:
+                f.write(name)
+        return write_manifest(upload_dir) if only is None else build_manifest(upload_dir)
+
+    sent = []
+    analysis = SimpleNamespace(id="a1", upload_output=lambda path: sent.append(os.path.basename(path)))
+    fw = SimpleNamespace(get_analysis=lambda analysis_id: analysis)
+    monkeypatch.setattr(fmriprep_upload, "build_uploads", build_uploads)
+
+    record = UploadRecord()
+    context = {"SRC": str(tmp_path), "bidspath": str(tmp_path / "sub-01" / "ses-01"), "fw": fw,
+               "subject": "01", "session": "S1", "run_level": "session",
+               "governor": RequestGovernor(backoff=0), "upload_record": record}
+    upload_dir = str(tmp_path / "upload")
+    os.makedirs(upload_dir)
+    fmriprep_upload.record_upload(context, analysis, build_uploads(context, upload_dir), upload_dir)
+    entry = record.entries["a1"]
+    assert (entry["subject"], entry["session"]) == ("01", "S1")
+
+    # labels come from the record, not the directory names
+    repair_context = fmriprep_upload.requeue_context(dict(context, subject=None, session=None), entry)
+    assert (repair_context["subject"], repair_context["session"]) == ("01", "S1")
+
+    built.clear()
+    assert fmriprep_upload.repair_analysis(repair_context, entry, ["logs.zip"])
+    assert built == ["logs.zip"]
+    assert sent == ["logs.zip"]
+
+    # a missing manifest is written from the record, nothing is rebuilt
+    built.clear()
+    sent.clear()
+    assert fmriprep_upload.repair_analysis(repair_context, entry, ["upload_manifest.json"])
+    assert built == [] and sent == ["upload_manifest.json"]
+    assert not os.path.exists(str(tmp_path / "tmp_upload"))
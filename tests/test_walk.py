@@ -0,0 +1,72 @@
+# unit tests for the shared directory walker...
+import os
+
+from fmriprep_upload import data_tree
+from utils.walk import human_size, walk_tree
+
+
+def _touch(path, data=b""):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def test_walk_tree_order_and_depth(tmp_path):
+    _touch(str(tmp_path / "b.txt"))
+    _touch(str(tmp_path / "a" / "x.txt"))
+    _touch(str(tmp_path / "a" / "c" / "y.txt"))
+    _touch(str(tmp_path / "d" / "z.txt"))
+
+    walked = [(relpath, depth) for relpath, _, depth in walk_tree(str(tmp_path), sort=True)]
+    assert walked == [
+        ("b.txt", 1),
+        ("a", 1),
+        ("a/x.txt", 2),
+        ("a/c", 2),
+        ("a/c/y.txt", 3),
+        ("d", 1),
+        ("d/z.txt", 2),
+    ]
+
+    # directories always come before their contents, sorted or not
+    seen = set()
+    for relpath, _, _ in walk_tree(str(tmp_path)):
+        parent = os.path.dirname(relpath)
+        assert not parent or parent in seen
+        seen.add(relpath)
+    assert len(seen) == len(walked)
+
+
+def test_walk_tree_exclude_prunes(tmp_path):
+    _touch(str(tmp_path / "keep" / "a.txt"))
+    _touch(str(tmp_path / "skip" / "b.txt"))
+    _touch(str(tmp_path / "keep" / "data_tree.txt"))
+
+    def exclude(relpath, entry):
+        return entry.name in ("skip", "data_tree.txt")
+
+    assert sorted(relpath for relpath, _, _ in walk_tree(str(tmp_path), exclude=exclude)) == ["keep", "keep/a.txt"]
+    assert list(walk_tree(str(tmp_path / "missing"))) == []
+
+
+def test_human_size():
+    assert human_size(0) == "0"
+    assert human_size(4096) == "4.0K"
+    assert human_size(4097) == "4.1K"
+    assert human_size(104 * 1024) == "104K"
+    assert human_size(1.5 * 1024 ** 3) == "1.5G"
+
+
+def test_data_tree(tmp_path):
+    root = tmp_path / "sub-01"
+    _touch(str(root / "anat" / "T1w.nii.gz"), b"x" * 10000)
+    _touch(str(root / "sub-01.html"), b"<html/>")
+    output = tmp_path / "data_tree.txt"
+
+    data_tree(str(root), str(output))
+    lines = output.read_text().splitlines()
+    assert lines[0] == "sub-01/"
+    assert lines[1].startswith("|----sub-01.html\t")
+    assert lines[2] == "anat/"
+    assert lines[3].startswith("    |----T1w.nii.gz\t")
+    assert lines[-1].startswith("Total Directory Size: ")
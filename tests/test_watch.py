@@ -0,0 +1,124 @@
+# unit tests for watch mode session detection...
+import os
+import time
+
+from utils.layout_index import LayoutIndex
+from utils.watch import DerivativeWatcher
+
+
+def test_watcher_finished_log(tmp_path):
+    (tmp_path / "sub-01" / "ses-01" / "anat").mkdir(parents=True)
+    (tmp_path / "sub-01" / "ses-02").mkdir(parents=True)
+    (tmp_path / "sub-011" / "ses-01").mkdir(parents=True)
+    logs = tmp_path / "logs"
+    logs.mkdir()
+    (logs / "sub-01_ses-01_fmriprep.log").write_text("running\n")
+
+    watcher = DerivativeWatcher(str(tmp_path), str(logs), quiet_period=3600)
+    assert watcher.scan() == []
+    assert len(watcher.pending) == 3
+
+    (logs / "sub-01_ses-01_fmriprep.log").write_text("running\nfMRIPrep finished successfully!\n")
+    assert watcher.scan() == [("sub-01", "ses-01")]
+    assert watcher.scan() == []
+
+    # subject level logs finish all sessions of that subject only
+    (logs / "fmriprep_sub-01.o1234").write_text("fMRIPrep finished successfully!\n")
+    assert watcher.scan() == [("sub-01", "ses-02")]
+
+
+def test_watcher_quiet_period_and_state(tmp_path):
+    session = tmp_path / "sub-01" / "ses-01"
+    session.mkdir(parents=True)
+    (session / "bold.nii.gz").write_bytes(b"x")
+    old = time.time() - 120
+    for path in [session / "bold.nii.gz", session]:
+        os.utime(str(path), (old, old))
+    state = str(tmp_path / "state.json")
+
+    watcher = DerivativeWatcher(str(tmp_path), str(tmp_path / "logs"), quiet_period=60, state_file=state)
+    assert watcher.scan() == [("sub-01", "ses-01")]
+    watcher.mark_done(("sub-01", "ses-01"))
+
+    # a restarted watcher skips sessions already uploaded
+    assert DerivativeWatcher(str(tmp_path), str(tmp_path / "logs"), quiet_period=60, state_file=state).scan() == []
+
+
+def test_watcher_running_log_blocks_quiet_period(tmp_path):
+    session = tmp_path / "sub-01" / "ses-01" / "anat"
+    session.mkdir(parents=True)
+    (session / "T1w.nii.gz").write_bytes(b"x")
+    old = time.time() - 7200
+    for path in [session / "T1w.nii.gz", session, session.parent]:
+        os.utime(str(path), (old, old))
+    logs = tmp_path / "logs"
+    logs.mkdir()
+    (logs / "fmriprep_sub-01.o1234").write_text("running recon-all\n")
+
+    watcher = DerivativeWatcher(str(tmp_path), str(logs), quiet_period=3600)
+    assert watcher.scan() == []
+
+    (logs / "fmriprep_sub-01.o1234").write_text("running recon-all\nfMRIPrep finished successfully!\n")
+    assert watcher.scan() == [("sub-01", "ses-01")]
+
+
+def test_watcher_retry_backoff_and_give_up(tmp_path):
+    session = tmp_path / "sub-01" / "ses-01"
+    session.mkdir(parents=True)
+    logs = tmp_path / "logs"
+    logs.mkdir()
+    (logs / "sub-01_ses-01_fmriprep.log").write_text("fMRIPrep finished successfully!\n")
+    state = str(tmp_path / "state.json")
+    key = ("sub-01", "ses-01")
+
+    watcher = DerivativeWatcher(str(tmp_path), str(logs), state_file=state, max_attempts=3, retry_delay=60)
+    assert watcher.scan() == [key]
+    assert watcher.retry(key, "connection dropped")
+
+    # not queued again until its retry delay passed
+    assert watcher.scan() == []
+    watcher._retry_at[key] = 0
+    assert watcher.scan() == [key]
+    assert watcher.retry(key, "connection dropped")
+    assert watcher._retry_at[key] - time.time() > 100
+
+    watcher._retry_at[key] = 0
+    assert watcher.scan() == [key]
+    assert not watcher.retry(key, "connection dropped")
+    assert watcher.scan() == [] and not watcher.pending
+
+    # the give-up is kept in the state file, a restarted watcher skips the session
+    restarted = DerivativeWatcher(str(tmp_path), str(logs), state_file=state)
+    assert restarted.given_up[key]["attempts"] == 3
+    assert restarted.given_up[key]["error"] == "connection dropped"
+    assert restarted.scan() == []
+
+
+def test_watcher_drops_removed_sessions(tmp_path):
+    session = tmp_path / "sub-01" / "ses-01"
+    session.mkdir(parents=True)
+    watcher = DerivativeWatcher(str(tmp_path), str(tmp_path / "logs"))
+    assert watcher.scan() == []
+    assert list(watcher.pending) == [("sub-01", "ses-01")]
+
+    session.rmdir()
+    assert watcher.scan() == []
+    assert not watcher.pending
+    assert watcher.scan() == []
+
+
+def test_watcher_discovers_sessions_from_layout_index(tmp_path):
+    src = tmp_path / "src"
+    (src / "sub-01" / "ses-01").mkdir(parents=True)
+    logs = tmp_path / "logs"
+    logs.mkdir()
+    (logs / "sub-01_fmriprep.log").write_text("fMRIPrep finished successfully!\n")
+    index = LayoutIndex(str(src), str(tmp_path / "index.sqlite"))
+
+    watcher = DerivativeWatcher(str(src), str(logs), layout=index)
+    assert watcher.scan() == [("sub-01", "ses-01")]
+
+    (src / "sub-01" / "ses-02").mkdir()
+    assert watcher.scan() == [("sub-01", "ses-02")]
+    # the shared index is kept current by the watcher
+    assert index.sessions() == [("sub-01", "ses-01"), ("sub-01", "ses-02")]
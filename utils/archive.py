@@ -0,0 +1,348 @@
+"""Build derivative archives: zip with a per-file-type compression policy, or multithreaded tar."""
+
+import contextlib
+import fnmatch
+import gzip
+import hashlib
+import io
+import json
+import logging
+import os
+import shutil
+import subprocess as sp
+import tarfile
+import zlib
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile
+
+from utils.walk import walk_tree
+
+log = logging.getLogger(__name__)
+
+# archive formats: zip can be browsed in flywheel, tar formats compress with all cores
+ARCHIVE_FORMATS = ("zip", "tar.zst", "tar.gz")
+
+# last member of tar archives, listing the size and sha256 of every other member
+ARCHIVE_MANIFEST = "archive_manifest.json"
+
+# marker used in a policy to request sample-based detection
+AUTO = "auto"
+
+# bytes read from the head of a file when guessing its compressibility
+SAMPLE_SIZE = 64 * 1024
+
+# a sample that shrinks by less than this is treated as already compressed
+AUTO_RATIO = 0.9
+
+# (glob, method, level) - first match wins, globs are matched on the file name
+DEFAULT_COMPRESSION_POLICY = [
+    # already compressed fmriprep outputs, deflate only buys ~1% here
+    ("*.nii.gz", ZIP_STORED, None),
+    ("*.gz", ZIP_STORED, None),
+    ("*.gii", ZIP_STORED, None),
+    ("*.h5", ZIP_STORED, None),
+    ("*.mgz", ZIP_STORED, None),
+    ("*.zip", ZIP_STORED, None),
+    ("*.png", ZIP_STORED, None),
+    ("*.jpg", ZIP_STORED, None),
+    ("*.jpeg", ZIP_STORED, None),
+    ("*.svgz", ZIP_STORED, None),
+    # text outputs compress well
+    ("*.tsv", ZIP_DEFLATED, 6),
+    ("*.json", ZIP_DEFLATED, 6),
+    ("*.html", ZIP_DEFLATED, 6),
+    ("*.svg", ZIP_DEFLATED, 6),
+    ("*.txt", ZIP_DEFLATED, 6),
+    ("*.log", ZIP_DEFLATED, 6),
+    ("*.csv", ZIP_DEFLATED, 6),
+    ("*.toml", ZIP_DEFLATED, 6),
+    ("*.sh", ZIP_DEFLATED, 6),
+    ("*.py", ZIP_DEFLATED, 6),
+    # uncompressed images are large, a fast level keeps most of the savings
+    ("*.nii", ZIP_DEFLATED, 1),
+    # anything else is decided from a sample of the file
+    ("*", AUTO, None),
+]
+
+
+def available_cpus():
+    """Return the number of cores this process may run on (the job's allocation, not the node's)."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # not available on macOS
+        return os.cpu_count() or 1
+
+
+def sample_compression(path, sample_size=SAMPLE_SIZE, ratio=AUTO_RATIO):
+    """Guess a compression method for a file from a sample of its contents.
+
+    Args:
+        path (str): file to inspect
+        sample_size (int): number of bytes read from the start of the file
+        ratio (float): compressed / raw size above which the file is stored
+
+    Returns:
+        (tuple): (method, level) usable with ZipFile.write
+    """
+    with open(path, "rb") as f:
+        sample = f.read(sample_size)
+
+    if not sample:
+        return ZIP_STORED, None
+
+    if len(zlib.compress(sample, 1)) / len(sample) > ratio:
+        return ZIP_STORED, None
+    return ZIP_DEFLATED, 6
+
+
+def compression_for(path, policy=None):
+    """Return the (method, level) the policy assigns to a file.
+
+    Args:
+        path (str): file to be archived
+        policy (list): (glob, method, level) tuples, defaults to
+            DEFAULT_COMPRESSION_POLICY
+
+    Returns:
+        (tuple): (method, level) usable with ZipFile.write
+    """
+    if policy is None:
+        policy = DEFAULT_COMPRESSION_POLICY
+
+    name = os.path.basename(path).lower()
+    for pattern, method, level in policy:
+        if fnmatch.fnmatchcase(name, pattern):
+            if method == AUTO:
+                return sample_compression(path)
+            return method, level
+
+    return ZIP_DEFLATED, None
+
+
+def load_compression_policy(path):
+    """Read a compression policy from a JSON file.
+
+    The file maps globs to "stored", "deflate", "deflate:<level>" or "auto",
+    e.g. {"*.nii.gz": "stored", "*.tsv": "deflate:9"}. Entries are tried in
+    file order and the default policy is used for files matching none of them.
+
+    Args:
+        path (str): JSON policy file
+
+    Returns:
+        (list): (glob, method, level) tuples
+    """
+    with open(path) as f:
+        rules = json.load(f)
+    if not isinstance(rules, dict):
+        raise ValueError(f"Compression policy {path} must be a JSON object mapping globs to rules")
+
+    policy = []
+    for pattern, rule in rules.items():
+        method, sep, level = str(rule).lower().partition(":")
+        if method == "stored" and not sep:
+            policy.append((pattern.lower(), ZIP_STORED, None))
+        elif method == "deflate":
+            # validated here, zipfile only rejects bad levels when the archive is closed
+            if sep and not (level.isdigit() and 0 <= int(level) <= 9):
+                raise ValueError(f"Deflate level for {pattern} must be 0-9: {rule}")
+            policy.append((pattern.lower(), ZIP_DEFLATED, int(level) if sep else 6))
+        elif method == AUTO and not sep:
+            policy.append((pattern.lower(), AUTO, None))
+        else:
+            raise ValueError(f"Unknown compression rule for {pattern}: {rule}")
+
+    return policy + DEFAULT_COMPRESSION_POLICY
+
+
+def archive_members(root_dir, source_dir, exclude_files=None):
+    """Yield (path, arcname, is_dir) of everything archived from <root_dir>/<source_dir>.
+
+    Members are yielded in sorted order so that unchanged inputs produce
+    byte-identical archives. Sorting needs the names of a whole directory,
+    so unlike unsorted walks memory is bounded by the largest directory
+    (as with os.walk), not by the tree depth. exclude_files holds paths
+    (relative to <root_dir>) or names of files and directories to leave
+    out; excluded directories are pruned.
+    """
+    exclude_from_output = set(exclude_files or [])
+    source_dir = os.path.normpath(source_dir)
+    prefix = "" if source_dir == os.curdir else source_dir
+
+    def _arcname(relpath):
+        return os.path.join(prefix, relpath) if prefix else relpath
+
+    def _excluded(relpath, entry):
+        return entry.name in exclude_from_output or _arcname(relpath) in exclude_from_output
+
+    for relpath, entry, _ in walk_tree(os.path.join(root_dir, source_dir), exclude=_excluded, sort=True):
+        # symlinked directories are archived as directory entries, not followed (as with os.walk)
+        try:
+            is_dir = entry.is_dir()
+        except OSError:
+            is_dir = False
+        yield entry.path, _arcname(relpath), is_dir
+
+
+def zip_output(root_dir, source_dir, output_zip_filename, dry_run=False, exclude_files=None, policy=None):
+    """Zip a directory, choosing STORED or DEFLATE per file.
+
+    Drop-in replacement for flywheel_gear_toolkit.utils.zip_tools.zip_output:
+    archive members are named relative to `root_dir`. Unlike the toolkit
+    version the working directory is left untouched, and excluded
+    directories are pruned rather than only dropping their own entry.
+
+    Args:
+        root_dir (str): The root directory to zip relative to.
+        source_dir (str): subdirectory (of <root_dir>) to zip.
+        output_zip_filename (str): Full path of the resultant output zip file.
+        dry_run (boolean, optional): Only log what would be archived.
+        exclude_files (list, optional): paths (relative to <root_dir>) or
+            names of files and directories to leave out of the archive.
+        policy (list, optional): (glob, method, level) tuples, defaults to
+            DEFAULT_COMPRESSION_POLICY
+
+    Raises:
+        FileNotFoundError: If `root_dir` does not exist.
+    """
+    if not os.path.exists(root_dir):
+        raise FileNotFoundError(f"The directory, {root_dir}, does not exist.")
+
+    log.info("Zipping output file %s", output_zip_filename)
+    if dry_run:
+        return
+
+    try:
+        os.remove(output_zip_filename)
+    except FileNotFoundError:
+        pass
+
+    stored = deflated = 0
+    with ZipFile(output_zip_filename, "w", ZIP_DEFLATED) as outzip:
+        for path, arcname, is_dir in archive_members(root_dir, source_dir, exclude_files):
+            if is_dir:
+                outzip.write(path, arcname)
+                continue
+            method, level = compression_for(path, policy)
+            outzip.write(path, arcname, compress_type=method, compresslevel=level)
+            if method == ZIP_STORED:
+                stored += 1
+            else:
+                deflated += 1
+
+    log.info("Archived %d files (%d stored, %d deflated)", stored + deflated, stored, deflated)
+
+
+class _HashingReader:
+    """File wrapper computing the sha256 of everything read through it."""
+
+    def __init__(self, f):
+        self.f = f
+        self.digest = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.digest.update(data)
+        return data
+
+
+@contextlib.contextmanager
+def _compressed_stream(fmt, output_filename, threads):
+    """Yield a writable stream compressing into output_filename with `threads` threads.
+
+    Uses the zstd / pigz command line tools when available. Without them
+    tar.zst falls back to the optional zstandard package and tar.gz to
+    single-threaded gzip.
+    """
+    if fmt == "tar.zst" and shutil.which("zstd"):
+        cmd = ["zstd", "-q", "-3", "-T%d" % threads, "-c"]
+    elif fmt == "tar.gz" and shutil.which("pigz"):
+        cmd = ["pigz", "-6", "-n", "-p", str(threads), "-c"]
+    else:
+        cmd = None
+
+    if cmd:
+        with open(output_filename, "wb") as out:
+            proc = sp.Popen(cmd, stdin=sp.PIPE, stdout=out)
+            try:
+                yield proc.stdin
+            finally:
+                proc.stdin.close()
+                returncode = proc.wait()
+        if returncode:
+            raise RuntimeError(f"{cmd[0]} failed with exit code {returncode} writing {output_filename}")
+
+    elif fmt == "tar.zst":
+        try:
+            import zstandard
+        except ImportError:
+            raise RuntimeError("tar.zst archives need the zstd command or the zstandard python package")
+        cctx = zstandard.ZstdCompressor(level=3, threads=threads)
+        with open(output_filename, "wb") as out, cctx.stream_writer(out) as stream:
+            yield stream
+
+    else:
+        log.warning("pigz not found, compressing %s with a single thread", output_filename)
+        with open(output_filename, "wb") as out, gzip.GzipFile(fileobj=out, mode="wb", compresslevel=6,
+                                                                 mtime=0) as stream:
+            yield stream
+
+
+def tar_output(root_dir, source_dir, output_filename, dry_run=False, exclude_files=None, fmt="tar.zst",
+               threads=None):
+    """Archive a directory as a tar stream compressed with multithreaded zstd or gzip.
+
+    Members are named relative to `root_dir` as in zip_output. The
+    archive ends with ARCHIVE_MANIFEST, listing the size and sha256 of
+    every member (computed while streaming, files are read once).
+
+    Args:
+        root_dir (str): The root directory to archive relative to.
+        source_dir (str): subdirectory (of <root_dir>) to archive.
+        output_filename (str): Full path of the resultant archive.
+        dry_run (boolean, optional): Only log what would be archived.
+        exclude_files (list, optional): paths (relative to <root_dir>) or
+            names of files and directories to leave out of the archive.
+        fmt (str, optional): "tar.zst" or "tar.gz"
+        threads (int, optional): compression threads, defaults to all cores
+
+    Raises:
+        FileNotFoundError: If `root_dir` does not exist.
+    """
+    if fmt not in ("tar.zst", "tar.gz"):
+        raise ValueError(f"Unknown tar format: {fmt}")
+    if not os.path.exists(root_dir):
+        raise FileNotFoundError(f"The directory, {root_dir}, does not exist.")
+
+    log.info("Creating %s archive %s", fmt, output_filename)
+    if dry_run:
+        return
+
+    threads = threads or available_cpus()
+    members = {}
+    with _compressed_stream(fmt, output_filename, threads) as stream:
+        with tarfile.open(fileobj=stream, mode="w|", format=tarfile.PAX_FORMAT) as tar:
+            for path, arcname, is_dir in archive_members(root_dir, source_dir, exclude_files):
+                info = tar.gettarinfo(path, arcname)
+                if is_dir or not info.isreg():
+                    tar.addfile(info)
+                    continue
+                with open(path, "rb") as f:
+                    reader = _HashingReader(f)
+                    tar.addfile(info, reader)
+                members[arcname] = {"size": info.size, "sha256": reader.digest.hexdigest()}
+
+            manifest = json.dumps({"format": fmt, "members": members}, indent=2, sort_keys=True).encode()
+            info = tarfile.TarInfo(ARCHIVE_MANIFEST)
+            info.size = len(manifest)
+            info.mtime = 0
+            tar.addfile(info, io.BytesIO(manifest))
+
+    log.info("Archived %d files with %d compression threads", len(members), threads)
+
+
+def build_archive(fmt, root_dir, source_dir, output_filename, exclude_files=None, policy=None, threads=None):
+    """Build a zip (see zip_output) or tar (see tar_output) archive."""
+    if fmt == "zip":
+        zip_output(root_dir, source_dir, output_filename, exclude_files=exclude_files, policy=policy)
+    else:
+        tar_output(root_dir, source_dir, output_filename, exclude_files=exclude_files, fmt=fmt, threads=threads)
@@ -0,0 +1,140 @@
+"""Content-addressed cache for archives that are identical across sessions."""
+
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+
+from utils.tool_cache import default_cache_dir
+from utils.walk import walk_tree
+
+log = logging.getLogger(__name__)
+
+# default size bound of the archive cache (bytes)
+DEFAULT_MAX_BYTES = 10 * 1024 ** 3
+
+
+def archive_key(root_dir, source_dir, exclude_files=None, extra=""):
+    """Hash the member list, sizes and mtimes of a directory to be archived.
+
+    Args:
+        root_dir (str): The root directory archive members are named relative to.
+        source_dir (str): subdirectory (of <root_dir>) to archive.
+        exclude_files (list, optional): paths or names left out of the archive
+        extra (str, optional): anything else the archive depends on, e.g. the
+            compression policy or archive format
+
+    Returns:
+        (str): sha256 hex digest
+    """
+    exclude_from_output = set(exclude_files or [])
+    source_dir = os.path.normpath(source_dir)
+
+    def _excluded(relpath, entry):
+        return entry.name in exclude_from_output or os.path.join(source_dir, relpath) in exclude_from_output
+
+    # members are combined order-independently so the walk needs no sorting
+    combined = count = 0
+    for relpath, entry, _ in walk_tree(os.path.join(root_dir, source_dir), exclude=_excluded):
+        if entry.is_dir(follow_symlinks=False):
+            continue
+        st = entry.stat(follow_symlinks=False)
+        member = hashlib.sha256(f"{relpath}\0{st.st_size}\0{st.st_mtime_ns}".encode()).digest()
+        combined = (combined + int.from_bytes(member, "big")) % 2 ** 256
+        count += 1
+
+    key = hashlib.sha256(f"{extra}\0{source_dir}\0{count}\0{combined:064x}".encode())
+    return key.hexdigest()
+
+
+def evict_archive_cache(cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+    """Remove least recently used archives until the cache fits in max_bytes."""
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.is_file() and not entry.name.endswith(".tmp"):
+            st = entry.stat()
+            entries.append((st.st_mtime, st.st_size, entry.path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        log.debug("Evicting cached archive %s", path)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def cached_archive(root_dir, source_dir, output_file, build, exclude_files=None, extra="",
+                   cache_dir=None, max_bytes=DEFAULT_MAX_BYTES):
+    """Place an archive of <root_dir>/<source_dir> at output_file, building it only on a cache miss.
+
+    Archives are stored under the hash of their inputs (see archive_key), so
+    scripts, configuration files and logs shared by every session of a
+    project are compressed once and then hard-linked (or copied, across
+    filesystems) into each session's upload directory.
+
+    Args:
+        root_dir (str): The root directory to archive relative to.
+        source_dir (str): subdirectory (of <root_dir>) to archive.
+        output_file (str): where the archive should be placed
+        build (callable): build(root_dir, source_dir, path) writes the archive to path
+        exclude_files (list, optional): paths or names left out of the archive
+        extra (str, optional): anything else the archive contents depend on
+        cache_dir (str, optional): defaults to default_cache_dir()/archives
+        max_bytes (int, optional): size bound of the cache
+
+    Returns:
+        (bool): True if the archive was served from the cache
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(default_cache_dir(), "archives")
+    os.makedirs(cache_dir, exist_ok=True)
+
+    suffix = os.path.basename(output_file).partition(".")[2]
+    key = archive_key(root_dir, source_dir, exclude_files, extra + suffix)
+    cached = os.path.join(cache_dir, key + "." + suffix)
+
+    if os.path.exists(cached):
+        log.info("Using cached archive %s for %s", cached, output_file)
+        try:
+            os.utime(cached)  # mark as recently used
+            _place(cached, output_file)
+            return True
+        except FileNotFoundError:
+            if os.path.exists(cached):
+                raise
+            # evicted by another process since the check above
+            log.info("Cached archive %s was evicted, rebuilding", cached)
+
+    # build next to the cache entry, place it from the temporary file (which no
+    # other process evicts) and then move it into the cache atomically
+    fd, tmp = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+    os.close(fd)
+    try:
+        build(root_dir, source_dir, tmp)
+        _place(tmp, output_file)
+        os.replace(tmp, cached)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+    evict_archive_cache(cache_dir, max_bytes)
+    return False
+
+
+def _place(source, output_file):
+    """Hard-link source to output_file, copying across filesystems."""
+    try:
+        os.remove(output_file)
+    except FileNotFoundError:
+        pass
+    try:
+        os.link(source, output_file)
+    except FileNotFoundError:
+        raise
+    except OSError:
+        shutil.copyfile(source, output_file)
@@ -0,0 +1,164 @@
+"""Shared, adaptive concurrency limit for Flywheel API calls."""
+
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# http status codes that signal the server is overloaded or throttling
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+# connection level errors raised by requests (used by the flywheel sdk), matched by
+# name because they derive from IOError rather than ConnectionError / TimeoutError
+RETRY_EXCEPTIONS = {"ConnectionError", "Timeout", "ConnectTimeout", "ReadTimeout", "ChunkedEncodingError"}
+
+
+def is_retryable(exc):
+    """Return True for throttling, server and connection errors."""
+    if isinstance(exc, (ConnectionError, TimeoutError)):
+        return True
+    if any(cls.__name__ in RETRY_EXCEPTIONS for cls in type(exc).__mro__):
+        return True
+    return getattr(exc, "status", None) in RETRY_STATUS
+
+
+class RequestGovernor:
+    """Cap in-flight API requests and adapt the cap AIMD-style.
+
+    Every worker in a batch sends its Flywheel calls through the same
+    governor. Successful fast calls raise the limit additively (about one
+    slot per limit's worth of successes); throttling, 5xx responses,
+    connection errors and calls slower than latency_target halve it, at
+    most once per cool-down period so that a burst of failures from calls
+    already in flight only counts once. Retryable errors are retried with
+    exponential backoff.
+
+    File transfers run under their own fixed cap (max_transfers) and are
+    left out of the adaptive limit, so a long upload never holds a slot
+    that metadata lookups wait for, and its duration or failure does not
+    shrink the limit.
+
+    Args:
+        max_concurrency (int): upper bound on in-flight requests
+        min_concurrency (int): lower bound on in-flight requests
+        latency_target (float): seconds above which a metadata call counts as congestion
+        retries (int): attempts after the first for retryable errors
+        backoff (float): initial retry delay in seconds, doubled per attempt
+        max_transfers (int): upper bound on in-flight file transfers
+    """
+
+    def __init__(self, max_concurrency=8, min_concurrency=1, latency_target=2.0, retries=4, backoff=1.0,
+                 max_transfers=4):
+        self.max_concurrency = max(max_concurrency, min_concurrency)
+        self.max_transfers = max(max_transfers, 1)
+        self.min_concurrency = min_concurrency
+        self.latency_target = latency_target
+        self.retries = retries
+        self.backoff = backoff
+
+        self.limit = float(min(self.max_concurrency, max(min_concurrency, 4)))
+        self.in_flight = 0
+        self.transfers = 0
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+
+        self.counters = {
+            "requests": 0,
+            "errors": 0,
+            "retries": 0,
+            "throttled": 0,
+            "decreases": 0,
+            "max_in_flight": 0,
+            "transfers": 0,
+            "max_transfers": 0,
+            "latency_total": 0.0,
+        }
+
+    def call(self, fn, *args, **kwargs):
+        """Call a metadata endpoint, e.g. governor.call(fw.get_session, session_id)."""
+        return self._run(fn, args, kwargs)
+
+    def call_once(self, fn, *args, **kwargs):
+        """Call an endpoint that is not idempotent (e.g. add_analysis) without retrying it.
+
+        A failed response does not mean nothing was created, callers decide
+        whether to look the result up before trying again.
+        """
+        return self._run(fn, args, kwargs, retries=0)
+
+    def transfer(self, fn, *args, **kwargs):
+        """Call a file transfer (upload / download) under the separate transfer cap."""
+        return self._run(fn, args, kwargs, transfer=True)
+
+    def stats(self):
+        """Return a snapshot of the counters, current limit and mean latency."""
+        with self._cond:
+            stats = dict(self.counters)
+            stats["limit"] = int(self.limit)
+            stats["in_flight"] = self.in_flight
+            stats["transfers_in_flight"] = self.transfers
+        stats["mean_latency"] = round(stats.pop("latency_total") / max(stats["requests"], 1), 3)
+        return stats
+
+    def _acquire(self, transfer=False):
+        with self._cond:
+            if transfer:
+                while self.transfers >= self.max_transfers:
+                    self._cond.wait()
+                self.transfers += 1
+                self.counters["transfers"] += 1
+                self.counters["max_transfers"] = max(self.counters["max_transfers"], self.transfers)
+                return
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+            self.counters["requests"] += 1
+            self.counters["max_in_flight"] = max(self.counters["max_in_flight"], self.in_flight)
+
+    def _release(self, latency, congested, transfer=False):
+        with self._cond:
+            if transfer:
+                self.transfers -= 1
+                self._cond.notify_all()
+                return
+            self.in_flight -= 1
+            self.counters["latency_total"] += latency
+            now = time.monotonic()
+            if congested:
+                if now - self._last_decrease > self.latency_target:
+                    self.limit = max(self.min_concurrency, self.limit / 2)
+                    self._last_decrease = now
+                    self.counters["decreases"] += 1
+                    log.debug("API concurrency decreased to %d", int(self.limit))
+            else:
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+    def _run(self, fn, args, kwargs, transfer=False, retries=None):
+        retries = self.retries if retries is None else retries
+        attempt = 0
+        while True:
+            self._acquire(transfer)
+            start = time.monotonic()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as exc:
+                retryable = is_retryable(exc)
+                self._release(time.monotonic() - start, congested=retryable, transfer=transfer)
+                with self._cond:
+                    self.counters["errors"] += 1
+                    if getattr(exc, "status", None) == 429:
+                        self.counters["throttled"] += 1
+                if not retryable or attempt >= retries:
+                    raise
+                delay = self.backoff * 2 ** attempt
+                log.warning("API call %s failed (%s), retrying in %.1fs", getattr(fn, "__name__", fn), exc, delay)
+                with self._cond:
+                    self.counters["retries"] += 1
+                attempt += 1
+                time.sleep(delay)
+            else:
+                latency = time.monotonic() - start
+                self._release(latency, congested=latency > self.latency_target, transfer=transfer)
+                return result
@@ -0,0 +1,211 @@
+"""Persistent, incrementally refreshed index of a BIDS derivative folder."""
+
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+
+from utils.tool_cache import default_cache_dir
+
+log = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    parent TEXT,
+    subject TEXT,
+    session TEXT,
+    mtime_ns INTEGER
+);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    dir TEXT,
+    subject TEXT,
+    session TEXT,
+    size INTEGER
+);
+CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent);
+CREATE INDEX IF NOT EXISTS files_dir ON files (dir);
+CREATE INDEX IF NOT EXISTS files_entities ON files (subject, session);
+"""
+
+
+def with_prefix(label, prefix):
+    """Return a bids label with its entity prefix, e.g. with_prefix("01", "sub-") == "sub-01".
+
+    Unlike label.strip("sub-"), characters of the label itself are never removed.
+    """
+    if label.startswith(prefix):
+        return label
+    return prefix + label
+
+
+def entities(relpath):
+    """Return the (subject, session) a path relative to the dataset root belongs to.
+
+    Session comes from a ses-* directory, or for files outside one (e.g.
+    sub-01/figures/sub-01_ses-01_desc-summary_bold.svg) from the file name.
+    """
+    parts = relpath.split(os.sep)
+    subject = parts[0] if parts[0].startswith("sub-") else None
+    session = None
+    if subject:
+        if len(parts) > 1 and parts[1].startswith("ses-"):
+            session = parts[1]
+        else:
+            for token in parts[-1].split("_"):
+                if token.startswith("ses-"):
+                    session = token
+                    break
+    return subject, session
+
+
+def default_index_path(src):
+    """Return the index location for a dataset, shared by every tool run on it."""
+    key = hashlib.sha256(os.path.abspath(src).encode()).hexdigest()[:16]
+    return os.path.join(default_cache_dir(), "layout", key + ".sqlite")
+
+
+class LayoutIndex:
+    """Index of the files, sizes and bids entities of a derivative folder.
+
+    The index is kept in sqlite so that queries such as all files of a
+    session or bytes per session take milliseconds. refresh() stats every
+    directory but only re-lists the ones whose mtime changed since the
+    last refresh (adding, removing or renaming entries updates a
+    directory's mtime, rewriting a file in place does not - use
+    refresh(full=True) after such changes).
+
+    Args:
+        src (str): dataset root
+        index_path (str, optional): sqlite file, defaults to default_index_path(src)
+        timeout (float, optional): seconds to wait for another process holding the write lock
+    """
+
+    def __init__(self, src, index_path=None, timeout=60):
+        self.src = os.path.abspath(src)
+        self.index_path = index_path or default_index_path(self.src)
+        index_dir = os.path.dirname(self.index_path)
+        if index_dir:
+            os.makedirs(index_dir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.index_path, timeout=timeout, check_same_thread=False)
+        self._db.executescript(SCHEMA)
+
+    def close(self):
+        self._db.close()
+
+    def refresh(self, top="", full=False, depth=None):
+        """Bring the index up to date, returning the number of directories re-listed.
+
+        Args:
+            top (str, optional): only refresh this sub-directory, e.g. "sub-01/ses-01"
+            full (bool, optional): re-list every directory regardless of its mtime
+            depth (int, optional): levels below top to refresh, e.g. depth=2 from the
+                dataset root refreshes the sub-* and sub-*/ses-* directories only
+        """
+        relisted = 0
+        with self._lock:
+            db = self._db
+            stack = [(os.path.normpath(top) if top else "", 0)]
+            while stack:
+                reldir, level = stack.pop()
+                path = os.path.join(self.src, reldir) if reldir else self.src
+                try:
+                    mtime = os.stat(path).st_mtime_ns
+                except FileNotFoundError:
+                    with db:
+                        self._forget(reldir)
+                    continue
+
+                descend = depth is None or level < depth
+                row = db.execute("SELECT mtime_ns FROM dirs WHERE path = ?", (reldir,)).fetchone()
+                if row and row[0] == mtime and not full:
+                    if descend:
+                        stack.extend((r[0], level + 1)
+                                     for r in db.execute("SELECT path FROM dirs WHERE parent = ?", (reldir,)))
+                    continue
+
+                relisted += 1
+                # one short transaction per directory, so other processes sharing
+                # the index are not locked out for a whole walk
+                with db:
+                    subdirs = self._relist(reldir, path, mtime)
+                if descend:
+                    stack.extend((sub, level + 1) for sub in subdirs)
+
+        log.debug("Layout index of %s refreshed, %d directories re-listed", self.src, relisted)
+        return relisted
+
+    def _relist(self, reldir, path, mtime):
+        """Re-read one directory into the index, returning its sub-directories."""
+        db = self._db
+        known = {r[0] for r in db.execute("SELECT path FROM dirs WHERE parent = ?", (reldir,))}
+        subdirs = []
+
+        def file_rows(it):
+            # stream file rows into sqlite instead of building a list per directory
+            for entry in it:
+                relpath = os.path.join(reldir, entry.name) if reldir else entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(relpath)
+                elif entry.is_file():
+                    yield (relpath, reldir) + entities(relpath) + (entry.stat().st_size,)
+
+        db.execute("DELETE FROM files WHERE dir = ?", (reldir,))
+        with os.scandir(path) as it:
+            db.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)", file_rows(it))
+
+        # drop directories that disappeared since the last listing
+        for gone in known - set(subdirs):
+            self._forget(gone)
+
+        db.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?, ?)",
+                   (reldir, None if reldir == "" else os.path.dirname(reldir)) + entities(reldir) + (mtime,))
+
+        # new directories get a placeholder mtime so they are listed below
+        for sub in subdirs:
+            if sub not in known:
+                db.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?, ?)",
+                           (sub, reldir) + entities(sub) + (-1,))
+        return subdirs
+
+    def _forget(self, reldir):
+        """Remove a directory and everything below it from the index."""
+        like = reldir.replace("%", r"\%").replace("_", r"\_") + os.sep + "%"
+        self._db.execute("DELETE FROM dirs WHERE path = ? OR path LIKE ? ESCAPE '\\'", (reldir, like))
+        self._db.execute("DELETE FROM files WHERE dir = ? OR dir LIKE ? ESCAPE '\\'", (reldir, like))
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def subjects(self):
+        """Return all sub-* labels."""
+        return [r[0] for r in self._query("SELECT path FROM dirs WHERE parent = '' AND subject = path ORDER BY path")]
+
+    def sessions(self, subject=None):
+        """Return (subject, session) of all sub-*/ses-* directories, optionally for one subject."""
+        sql = "SELECT subject, session FROM dirs WHERE session IS NOT NULL AND path = subject || ? || session"
+        params = (os.sep,)
+        if subject:
+            sql += " AND subject = ?"
+            params += (subject,)
+        return [tuple(r) for r in self._query(sql + " ORDER BY subject, session", params)]
+
+    def files(self, subject, session=None):
+        """Return [(relative path, size)] of a subject, or of one of its sessions."""
+        if session:
+            rows = self._query("SELECT path, size FROM files WHERE subject = ? AND session = ? ORDER BY path",
+                               (subject, session))
+        else:
+            rows = self._query("SELECT path, size FROM files WHERE subject = ? ORDER BY path", (subject,))
+        return [tuple(r) for r in rows]
+
+    def session_bytes(self):
+        """Return {(subject, session): total bytes} for every session."""
+        rows = self._query("SELECT subject, session, SUM(size) FROM files "
+                           "WHERE subject IS NOT NULL AND session IS NOT NULL GROUP BY subject, session")
+        return {(r[0], r[1]): r[2] for r in rows}
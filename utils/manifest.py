@@ -0,0 +1,94 @@
+"""Upload manifests: names, sizes and digests of the files attached to an analysis."""
+
+import hashlib
+import json
+import logging
+import os
+
+log = logging.getLogger(__name__)
+
+MANIFEST_NAME = "upload_manifest.json"
+
+# read size used when hashing files
+CHUNK_SIZE = 1024 * 1024
+
+
+def file_sha256(path):
+    """Return the sha256 hex digest of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def build_manifest(upload_dir):
+    """Describe every file in an upload directory.
+
+    Args:
+        upload_dir (str): directory of files to be uploaded
+
+    Returns:
+        (dict): {name: {"size": bytes, "sha256": digest}}
+    """
+    manifest = {}
+    for entry in sorted(os.scandir(upload_dir), key=lambda e: e.name):
+        if entry.is_file() and entry.name != MANIFEST_NAME:
+            manifest[entry.name] = {"size": entry.stat().st_size, "sha256": file_sha256(entry.path)}
+    return manifest
+
+
+def write_manifest(upload_dir, manifest=None):
+    """Write the manifest of an upload directory into it, returning the manifest.
+
+    Args:
+        upload_dir (str): directory of files to be uploaded
+        manifest (dict, optional): manifest to write instead of describing upload_dir,
+            e.g. a recorded manifest with some files rebuilt
+    """
+    if manifest is None:
+        manifest = build_manifest(upload_dir)
+    with open(os.path.join(upload_dir, MANIFEST_NAME), "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def read_manifest(path):
+    """Read a manifest written by write_manifest, returning {} if it is unusable."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        log.warning("Unable to read manifest %s: %s", path, e)
+        return {}
+
+
+def files_to_sync(local_manifest, remote_sizes, remote_manifest=None, manifest_size=None):
+    """Select the local files that are missing or different remotely.
+
+    A file is re-uploaded if it is missing from the remote listing, its
+    size differs, or the remote manifest records a different digest. The
+    manifest itself (which it does not list) is re-uploaded whenever
+    anything else is, or when it is missing or a different size remotely.
+
+    Args:
+        local_manifest (dict): manifest of the local upload directory
+        remote_sizes (dict): {name: size} of the files attached to the analysis
+        remote_manifest (dict, optional): manifest previously uploaded to the analysis
+        manifest_size (int, optional): size of the local manifest file, if it is synced too
+
+    Returns:
+        (list): names of the files to upload
+    """
+    remote_manifest = remote_manifest or {}
+    changed = []
+    for name, local in sorted(local_manifest.items()):
+        if name not in remote_sizes or remote_sizes[name] != local["size"]:
+            changed.append(name)
+        elif name in remote_manifest and remote_manifest[name].get("sha256") != local["sha256"]:
+            changed.append(name)
+
+    if manifest_size is not None and (changed or remote_sizes.get(MANIFEST_NAME) != manifest_size):
+        # keep the remote manifest in step with the files
+        changed.append(MANIFEST_NAME)
+    return changed
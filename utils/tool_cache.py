@@ -0,0 +1,116 @@
+"""Cache the help output of analysis tools and container images."""
+
+import hashlib
+import logging
+import os
+import shlex
+import shutil
+import subprocess as sp
+import tempfile
+
+log = logging.getLogger(__name__)
+
+# bytes hashed from each end of a tool or image when building its digest
+DIGEST_BLOCK = 1024 * 1024
+
+
+def default_cache_dir():
+    """Return the cache directory shared by all data ingestion tools."""
+    base = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.environ.get("DATA_INGESTION_CACHE", os.path.join(base, "data_ingestion_tools"))
+
+
+def file_digest(path, block=DIGEST_BLOCK):
+    """Digest a (possibly multi-GB) file from its size and its first and last block.
+
+    Args:
+        path (str): file to digest
+        block (int): number of bytes read from each end of the file
+
+    Returns:
+        (str): sha256 hex digest
+    """
+    size = os.path.getsize(path)
+    digest = hashlib.sha256(str(size).encode())
+    with open(path, "rb") as f:
+        digest.update(f.read(block))
+        if size > 2 * block:
+            f.seek(-block, os.SEEK_END)
+            digest.update(f.read(block))
+    return digest.hexdigest()
+
+
+def tool_paths(cmd):
+    """Return the executable and container image files a command depends on.
+
+    Args:
+        cmd (str): command line used to run the tool
+
+    Returns:
+        (list): absolute paths of existing files referenced by the command
+    """
+    tokens = shlex.split(cmd)
+    paths = []
+    if tokens:
+        exe = shutil.which(tokens[0])
+        if exe:
+            paths.append(os.path.realpath(exe))
+    # container images (and any other file arguments) are part of the tool
+    for token in tokens[1:]:
+        if os.path.isfile(token):
+            paths.append(os.path.realpath(token))
+    return paths
+
+
+def tool_cache_key(cmd):
+    """Build a cache key from a command and the path, mtime and digest of its files."""
+    key = hashlib.sha256(cmd.encode())
+    for path in tool_paths(cmd):
+        key.update(path.encode())
+        key.update(str(os.stat(path).st_mtime_ns).encode())
+        key.update(file_digest(path).encode())
+    return key.hexdigest()
+
+
+def cached_tool_help(cmd, cache_dir=None):
+    """Return the "-h" output of a tool, running it only on a cache miss.
+
+    Entries are keyed by tool_cache_key so that replacing an executable or
+    container image invalidates them, while a batch of sessions using the
+    same image only pays the container start-up once.
+
+    Args:
+        cmd (str): command line used to run the tool
+        cache_dir (str): where cached help text is kept, defaults to
+            default_cache_dir()/tool_info
+
+    Returns:
+        (str): help text printed by the tool
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(default_cache_dir(), "tool_info")
+
+    cache_file = os.path.join(cache_dir, tool_cache_key(cmd) + ".txt")
+    if os.path.exists(cache_file):
+        log.info("Using cached tool information %s", cache_file)
+        with open(cache_file) as f:
+            return f.read()
+
+    log.info("Running %s -h", cmd)
+    Results = sp.Popen(
+        cmd + " -h", shell=True, stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True
+    )
+    stdout, _ = Results.communicate()
+
+    if not stdout:
+        log.warning("No help output from %s, result not cached", cmd)
+        return stdout
+
+    # write atomically, concurrent job array tasks may race on a cold cache
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        f.write(stdout)
+    os.replace(tmp, cache_file)
+
+    return stdout
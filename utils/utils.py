@@ -40,6 +40,26 @@ def analysis_exists(fw_container, analysis_name, exclude_list=[]):
     return flag
 
 
+def latest_analysis(fw_container, label_prefix):
+    """Return the most recently created ad-hoc analysis whose label starts with label_prefix
+
+    Analyses run by a gear (those with a job, including failed ones) are
+    never returned, files must only be added to analyses created by an upload.
+
+    Args:
+       fw_container: full flywheel session or subject (use fw.get_session(session.id))
+       label_prefix (str): label prefix of the upload analyses, e.g. "bids-fmriprep: Upload"
+
+    Returns:
+       (flywheel.AnalysisOutput): latest matching analysis or None
+    """
+    matches = [analysis for analysis in fw_container.analyses
+               if analysis.label.startswith(label_prefix) and getattr(analysis, 'job', None) is None]
+    if not matches:
+        return None
+    return max(matches, key=lambda analysis: analysis.created)
+
+
 """Compress HTML files."""
 
 import datetime
@@ -48,8 +68,13 @@ import logging
 import os
 import subprocess as sp
 from pathlib import Path
-from bs4 import BeautifulSoup
+from urllib.parse import unquote, urlparse
 import shutil
+import time
+import zipfile
+
+from utils.archive import compression_for
+from utils.layout_index import entities
 
 
 # FWV0 = Path.cwd()
@@ -71,6 +96,9 @@ def set_relative_hyperlinks(landing_html, relpath=os.curdir):
     Returns:
         writes updated html with relative paths
     """
+    # bs4 is only needed here, keep it out of module import time
+    from bs4 import BeautifulSoup
+
     data = landing_html  # html file location
 
     # load the file
@@ -295,3 +323,108 @@ def zip_htmls(output_dir, destination_id, path, inputfile=None):
 
     # cleanup
     os.chdir(workdir)
+
+
+# (tag, attribute) pairs that may point at report assets
+REPORT_REFERENCES = [
+    ('img', 'src'),
+    ('object', 'data'),
+    ('embed', 'src'),
+    ('source', 'src'),
+    ('iframe', 'src'),
+    ('script', 'src'),
+    ('link', 'href'),
+    ('a', 'href'),
+]
+
+
+def _session_block(element, session):
+    """Return the report section of another session containing element (or element itself)."""
+    for parent in element.parents:
+        if parent.name == 'div' and 'session-' in parent.get('id', ''):
+            # niworkflows section ids look like datatype-figures_session-01_suffix-bold
+            if 'session-' + session[len('ses-'):] not in parent['id'].split('_'):
+                return parent
+    return element
+
+
+def zip_fmriprep_report(src, subject, output_dir, session=None, destination_id=None, policy=None):
+    """Bundle a fmriprep subject report as a viewable *.html.zip for one session.
+
+    The report (<src>/<subject>.html) is parsed once. Figures and other
+    local assets it references are collected, references to figures of
+    other sessions are pruned (with their report section where it can be
+    identified), paths are rewritten relative to the archive, and the
+    archive is written in the same pass - nothing is copied to a
+    temporary directory first. The html is stored as index.html so that
+    Flywheel displays the archive, as in zip_htmls.
+
+    Args:
+        src (str): fmriprep derivative folder containing <subject>.html
+        subject (str): subject label, e.g. sub-01
+        output_dir (str): where the html.zip should be stored
+        session (str, optional): session label, e.g. ses-01; all sessions are kept if None
+        destination_id (str, optional): suffix for the html.zip file, defaults to the session
+        policy (list, optional): compression policy (see utils.archive)
+
+    Returns:
+        (str): path of the html.zip, or None if the subject has no report
+    """
+    # bs4 is only needed here, keep it out of module import time
+    from bs4 import BeautifulSoup
+
+    report = os.path.join(src, subject + '.html')
+    if not os.path.exists(report):
+        logging.warning("No fmriprep report found: %s", report)
+        return None
+
+    with open(report) as inf:
+        soup = BeautifulSoup(inf.read(), 'html.parser')
+
+    assets = {}  # arcname -> path
+    pruned = 0
+    for tag, attr in REPORT_REFERENCES:
+        for element in soup.find_all(tag):
+            if getattr(element, 'decomposed', False):
+                continue  # inside a section pruned earlier
+            ref = element.get(attr)
+            if not ref:
+                continue
+            url = urlparse(ref)
+            if url.scheme or url.netloc or not url.path:
+                continue  # external links, data: uris and in-page anchors
+
+            path = os.path.normpath(os.path.join(src, unquote(url.path)))
+            relpath = os.path.relpath(path, src)
+            _, ref_session = entities(relpath)
+            if session and ref_session and ref_session != session:
+                _session_block(element, session).decompose()
+                pruned += 1
+                continue
+
+            if not os.path.isfile(path):
+                if tag != 'a':
+                    logging.warning("Report asset not found: %s", path)
+                continue
+
+            arcname = relpath if not relpath.startswith(os.pardir) else os.path.join('assets', os.path.basename(path))
+            assets[arcname] = path
+            element[attr] = arcname + ('#' + url.fragment if url.fragment else '')
+
+    dest_zip = os.path.join(output_dir, subject + '_' + (destination_id or session or 'report') + '.html.zip')
+    logging.info('Creating viewable archive "%s"', dest_zip)
+
+    # date index.html with the report's mtime (not the build time) so an unchanged
+    # report gives an identical archive and is skipped by --sync
+    index = zipfile.ZipInfo('index.html', date_time=time.localtime(max(os.path.getmtime(report), 315619200))[:6])
+    index.compress_type = zipfile.ZIP_DEFLATED
+    index.external_attr = 0o644 << 16
+
+    with zipfile.ZipFile(dest_zip, 'w', zipfile.ZIP_DEFLATED) as outzip:
+        outzip.writestr(index, str(soup))
+        for arcname, path in sorted(assets.items()):
+            method, level = compression_for(path, policy)
+            outzip.write(path, arcname, compress_type=method, compresslevel=level)
+
+    logging.info("Bundled %s with %d assets (%d references to other sessions pruned)", report, len(assets), pruned)
+    return dest_zip
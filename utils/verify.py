@@ -0,0 +1,137 @@
+"""Batch verification of uploaded analyses against the local record of expected files."""
+
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+
+class UploadRecord:
+    """Thread-safe record of the files each analysis of a batch should hold.
+
+    Upload workers add one entry per analysis before its files are sent
+    (so uploads failing partway are checked too); the entries are later
+    checked against a single listing per analysis (see verify_uploads).
+    With path set, entries are also appended to a JSON lines file so a
+    batch can be verified again after the process exits.
+
+    Args:
+        path (str, optional): JSON lines file the entries are appended to
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = {}
+        self._lock = threading.Lock()
+
+    def add(self, analysis_id, files, **info):
+        """Record the expected {name: size} of an analysis, replacing an earlier entry.
+
+        Args:
+            analysis_id (str): flywheel analysis id
+            files (dict): {name: size in bytes} of every file the analysis should hold
+            **info: anything identifying the upload in the report, e.g. subject, session
+        """
+        entry = dict(info, analysis=analysis_id, files=dict(files), recorded=time.time())
+        with self._lock:
+            self.entries[analysis_id] = entry
+            if self.path:
+                with open(self.path, "a") as f:
+                    f.write(json.dumps(entry, sort_keys=True) + "\n")
+
+    @classmethod
+    def load(cls, path):
+        """Read a record written with path set, later entries of an analysis win."""
+        record = cls(path)
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    record.entries[entry["analysis"]] = entry
+        return record
+
+
+def compare_files(expected, remote):
+    """Compare the expected and remote {name: size} of one analysis.
+
+    Returns:
+        (dict): {"missing": [names], "size_mismatch": {name: [expected, remote]}},
+            files only present remotely are ignored
+    """
+    missing = sorted(name for name in expected if name not in remote)
+    size_mismatch = {name: [size, remote[name]] for name, size in sorted(expected.items())
+                     if name in remote and remote[name] != size}
+    return {"missing": missing, "size_mismatch": size_mismatch}
+
+
+def verify_uploads(entries, list_files, workers=4):
+    """Check analyses with one listing call each, instead of one call per file.
+
+    Args:
+        entries (list): UploadRecord entries to check, e.g. record.entries.values()
+        list_files (callable): list_files(analysis_id) returning the remote
+            {name: size}, e.g. from a single fw.get_analysis call
+        workers (int): listing calls made in parallel
+
+    Returns:
+        (dict): {analysis id: result}, result is compare_files() plus
+            "ok" (bool) and "error" (str or None)
+    """
+    def check(entry):
+        try:
+            remote = list_files(entry["analysis"])
+        except Exception as e:
+            log.error("Unable to list analysis %s: %s", entry["analysis"], e)
+            return dict(missing=sorted(entry["files"]), size_mismatch={}, ok=False, error=str(e))
+        result = compare_files(entry["files"], remote)
+        result.update(ok=not result["missing"] and not result["size_mismatch"], error=None)
+        return result
+
+    entries = list(entries)
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        results = list(pool.map(check, entries))
+    return {entry["analysis"]: result for entry, result in zip(entries, results)}
+
+
+def write_report(path, record, results, requeued=None, given_up=None):
+    """Write one JSON report covering every analysis of a batch.
+
+    Args:
+        path (str): report location
+        record (UploadRecord): expected files per analysis
+        results (dict): final verify_uploads() results
+        requeued (dict, optional): {analysis id: first-pass result} of the
+            analyses that were uploaded again
+        given_up (list, optional): sessions whose upload was given up in watch
+            mode, e.g. {"subject": .., "session": .., "attempts": .., "error": ..}
+
+    Returns:
+        (dict): the report
+    """
+    requeued = requeued or {}
+    analyses = []
+    for analysis_id, entry in sorted(record.entries.items()):
+        result = results.get(analysis_id, {})
+        info = {k: v for k, v in entry.items() if k not in ("files", "manifest", "recorded")}
+        info.update(result, files=len(entry["files"]), bytes=sum(entry["files"].values()))
+        if analysis_id in requeued:
+            info["first_pass"] = requeued[analysis_id]
+        analyses.append(info)
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "analyses": len(analyses),
+        "verified": sum(1 for a in analyses if a.get("ok")),
+        "requeued": len(requeued),
+        "failed": [a["analysis"] for a in analyses if not a.get("ok")],
+        "given_up": list(given_up or []),
+        "results": analyses,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    return report
@@ -0,0 +1,140 @@
+"""Memory-bounded directory walking shared by every tree-processing path."""
+
+import contextlib
+import logging
+import math
+import os
+import stat
+
+log = logging.getLogger(__name__)
+
+
+def walk_tree(top, exclude=None, sort=False):
+    """Yield (relpath, entry, depth) for everything below top.
+
+    Unlike os.walk, directory listings are not materialized (unless sort
+    is set): files are yielded straight from os.scandir and only the
+    sub-directory entries of each directory on the current path are kept
+    until they are visited, so memory grows with tree depth rather than
+    directory size.
+    The DirEntry objects cache their stat results (entry.stat() costs no
+    extra system call for most fields on Linux after the first).
+
+    Each directory is yielded before its contents; within a directory
+    files come before sub-directories. Symlinks are yielded but not
+    followed.
+
+    Args:
+        top (str): directory to walk (not itself yielded)
+        exclude (callable, optional): exclude(relpath, entry) returning True
+            for entries to skip; excluded directories are not descended
+        sort (bool, optional): yield entries of each directory in name
+            order (reproducible archives); this holds the names of one
+            directory in memory at a time (about what os.walk holds) and
+            yields lightweight DirEntry stand-ins that stat lazily
+
+    Yields:
+        (tuple): (path relative to top, os.DirEntry, depth) where depth is
+            the number of components of the relative path (with sort, an
+            object offering the same name / path / is_dir / is_file / stat)
+    """
+    pending = [("", None, 0)]
+    while pending:
+        reldir, dir_entry, depth = pending.pop()
+        if dir_entry is not None:
+            yield reldir, dir_entry, depth
+
+        path = os.path.join(top, reldir) if reldir else top
+        try:
+            if sort:
+                # sort bare names: DirEntry objects are several times larger, and
+                # short-lived ones fragment the heap while a listing is collected
+                names = os.listdir(path)
+                names.sort()
+                listing = contextlib.nullcontext(_PathEntry(path, name) for name in names)
+            else:
+                listing = os.scandir(path)
+        except (FileNotFoundError, NotADirectoryError, PermissionError) as e:
+            log.warning("Unable to list %s: %s", e.filename, e.strerror)
+            continue
+
+        subdirs = []
+        with listing as entries:
+            for entry in entries:
+                relpath = os.path.join(reldir, entry.name) if reldir else entry.name
+                if exclude is not None and exclude(relpath, entry):
+                    continue
+                try:
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                except OSError:
+                    is_dir = False
+                if is_dir:
+                    subdirs.append((relpath, entry, depth + 1))
+                else:
+                    yield relpath, entry, depth + 1
+
+        # drop this listing before the next one is read
+        names = listing = entries = None
+
+        # pending is a stack, push in reverse so directories are visited in listing order
+        pending.extend(reversed(subdirs))
+
+
+class _PathEntry:
+    """Minimal os.DirEntry stand-in used by sorted walks, stats are made on first use and cached."""
+
+    __slots__ = ("name", "path", "_stat", "_lstat")
+
+    def __init__(self, parent, name):
+        self.name = name
+        self.path = os.path.join(parent, name)
+        self._stat = self._lstat = None
+
+    def __repr__(self):
+        return "<_PathEntry %r>" % self.name
+
+    def stat(self, follow_symlinks=True):
+        if follow_symlinks:
+            if self._stat is None:
+                self._stat = os.stat(self.path)
+            return self._stat
+        if self._lstat is None:
+            self._lstat = os.lstat(self.path)
+        return self._lstat
+
+    def _mode(self, follow_symlinks):
+        try:
+            return self.stat(follow_symlinks=follow_symlinks).st_mode
+        except FileNotFoundError:
+            return 0
+
+    def is_dir(self, follow_symlinks=True):
+        return stat.S_ISDIR(self._mode(follow_symlinks))
+
+    def is_file(self, follow_symlinks=True):
+        return stat.S_ISREG(self._mode(follow_symlinks))
+
+    def is_symlink(self):
+        return stat.S_ISLNK(self._mode(False))
+
+
+def disk_usage(entry):
+    """Return the bytes a DirEntry occupies on disk, as counted by du."""
+    st = entry.stat(follow_symlinks=False)
+    return getattr(st, "st_blocks", math.ceil(st.st_size / 512)) * 512
+
+
+def human_size(nbytes):
+    """Format a byte count the way "du -h" does (e.g. 0, 4.0K, 12M, 1.2G)."""
+    if nbytes < 1024:
+        return str(int(nbytes))
+    for unit in ["K", "M", "G", "T", "P"]:
+        nbytes /= 1024
+        if nbytes < 1024 or unit == "P":
+            break
+    # du rounds up, to one decimal below 10
+    if nbytes < 10:
+        value = math.ceil(nbytes * 10) / 10
+        if value < 10:
+            return "%.1f%s" % (value, unit)
+    return "%d%s" % (math.ceil(nbytes), unit)
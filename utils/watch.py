@@ -0,0 +1,276 @@
+"""Detect fmriprep sessions that finished since the last scan."""
+
+import json
+import logging
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+
+from utils.walk import walk_tree
+
+log = logging.getLogger(__name__)
+
+# written by fmriprep at the end of a successful run
+FINISHED_MARKER = b"finished successfully"
+
+# bytes read from the end of a log when looking for FINISHED_MARKER
+LOG_TAIL = 8 * 1024
+
+
+def _scandir_names(path, prefix):
+    """Return {name: path} of the sub-directories of path starting with prefix."""
+    try:
+        return {e.name: e.path for e in os.scandir(path) if e.name.startswith(prefix) and e.is_dir()}
+    except FileNotFoundError:
+        return {}
+
+
+def _log_finished(path):
+    """Return True if the end of a log contains the fmriprep success message."""
+    try:
+        with open(path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - LOG_TAIL))
+            return FINISHED_MARKER in f.read()
+    except OSError:
+        return False
+
+
+def latest_mtime(path):
+    """Return the newest mtime (seconds) of a directory tree."""
+    newest = os.stat(path).st_mtime
+    for _, entry, _ in walk_tree(path):
+        try:
+            newest = max(newest, entry.stat(follow_symlinks=False).st_mtime)
+        except FileNotFoundError:
+            pass
+    return newest
+
+
+class DerivativeWatcher:
+    """Incrementally scan a fmriprep derivative folder for finished sessions.
+
+    A sub-*/ses-* session is finished once a log in log_dir naming its
+    subject (and session, if the log name has one) ends with fmriprep's
+    success message. Sessions no log names are finished once nothing in
+    their tree changed for quiet_period seconds; a session with a running
+    log is never finished by the quiet period (outputs may not change for
+    hours while e.g. recon-all runs). Directory listings are only re-read
+    when the directory mtime changed and logs only when their own mtime
+    changed, so a cycle costs a few stat calls plus a walk of the sessions
+    still pending.
+
+    A session whose upload failed is retried after retry_delay seconds,
+    doubled per failed attempt, and given up after max_attempts failures.
+    Sessions given up are recorded in the state file next to the uploaded
+    ones and are not retried by a restarted watcher.
+
+    With layout set, sessions are discovered from the shared layout index
+    (refreshed two levels deep each scan), so the index stays current for
+    other runs and the size reports of the sessions uploaded.
+
+    Args:
+        src (str): fmriprep derivative folder
+        log_dir (str): fmriprep logs (directory or single file)
+        quiet_period (float): seconds without changes after which a session is finished
+        state_file (str, optional): json file recording sessions already handled,
+            so that a restarted watcher does not upload them again
+        max_attempts (int): failed uploads after which a session is given up
+        retry_delay (float): seconds before the first retry of a failed session
+        layout (LayoutIndex, optional): index of src used to discover sessions
+    """
+
+    def __init__(self, src, log_dir, quiet_period=3600, state_file=None, max_attempts=5, retry_delay=300,
+                 layout=None):
+        self.src = src
+        self.log_dir = log_dir
+        self.quiet_period = quiet_period
+        self.state_file = state_file
+        self.max_attempts = max(max_attempts, 1)
+        self.retry_delay = retry_delay
+        self.layout = layout
+
+        self.pending = {}
+        self.in_progress = set()
+        self.done = set()
+        self.given_up = {}
+        self.attempts = {}
+        self._retry_at = {}
+        self._dir_mtimes = {}
+        self._subjects = {}
+        self._log_mtimes = {}
+        self._finished_logs = set()
+        self._lock = threading.Lock()
+
+        if state_file and os.path.exists(state_file):
+            with open(state_file) as f:
+                state = json.load(f)
+            if isinstance(state, list):
+                # written before give-ups were recorded
+                state = {"done": state}
+            self.done = {tuple(key) for key in state.get("done", [])}
+            self.given_up = {(entry["subject"], entry["session"]): entry for entry in state.get("given_up", [])}
+
+    def scan(self):
+        """Return (subject, session) labels of newly finished sessions, e.g. ("sub-01", "ses-01")."""
+        self._refresh_sessions()
+        self._refresh_logs()
+
+        with self._lock:
+            pending = sorted(self.pending.items())
+
+        now = time.time()
+        ready = []
+        removed = []
+        for key, path in pending:
+            if self._retry_at.get(key, 0) > now:
+                continue
+            try:
+                if not os.path.isdir(path):
+                    raise FileNotFoundError(path)
+                finished = self._finished_by_log(key)
+                if finished is None:
+                    # no log names this session, fall back to the quiet period
+                    finished = now - latest_mtime(path) > self.quiet_period
+                if finished:
+                    ready.append(key)
+            except FileNotFoundError:
+                log.warning("Session removed while watching, no longer watching it: %s", path)
+                removed.append(key)
+
+        with self._lock:
+            for key in removed:
+                # picked up again by _refresh_sessions if the session reappears
+                self.pending.pop(key, None)
+                self.attempts.pop(key, None)
+                self._retry_at.pop(key, None)
+            for key in ready:
+                self.pending.pop(key, None)
+                self.in_progress.add(key)
+        return ready
+
+    def mark_done(self, key):
+        """Record a session as uploaded."""
+        with self._lock:
+            self.in_progress.discard(key)
+            self.attempts.pop(key, None)
+            self._retry_at.pop(key, None)
+            self.done.add(key)
+            self._save_state()
+
+    def retry(self, key, error=None):
+        """Count a failed upload of a session, schedule its retry or give it up.
+
+        Args:
+            key (tuple): (subject, session) labels
+            error (str, optional): reason of the failure, kept if the session is given up
+
+        Returns:
+            (bool): True if the session will be retried, False if it was given up
+        """
+        with self._lock:
+            self.in_progress.discard(key)
+            attempts = self.attempts.get(key, 0) + 1
+            if attempts >= self.max_attempts:
+                self.attempts.pop(key, None)
+                self._retry_at.pop(key, None)
+                self.given_up[key] = {"subject": key[0], "session": key[1], "attempts": attempts,
+                                      "error": error, "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+                self._save_state()
+                log.error("Giving up on %s %s after %d failed uploads", key[0], key[1], attempts)
+                return False
+            self.attempts[key] = attempts
+            delay = self.retry_delay * 2 ** (attempts - 1)
+            self._retry_at[key] = time.time() + delay
+            self.pending[key] = os.path.join(self.src, *key)
+            log.warning("Upload of %s %s failed (attempt %d of %d), retrying in %ds",
+                        key[0], key[1], attempts, self.max_attempts, delay)
+            return True
+
+    def _save_state(self):
+        """Atomically write the sessions uploaded and given up, called with the lock held."""
+        if not self.state_file:
+            return
+        state = {"done": sorted(self.done), "given_up": [self.given_up[key] for key in sorted(self.given_up)]}
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.state_file)), suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp, self.state_file)
+
+    def _changed(self, path):
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return False
+        if self._dir_mtimes.get(path) == mtime:
+            return False
+        self._dir_mtimes[path] = mtime
+        return True
+
+    def _refresh_sessions(self):
+        found = self._indexed_sessions() if self.layout is not None else None
+        if found is None:
+            found = {}
+            if self._changed(self.src):
+                self._subjects = _scandir_names(self.src, "sub-")
+            for subject, subject_path in self._subjects.items():
+                if self._changed(subject_path):
+                    for session, session_path in _scandir_names(subject_path, "ses-").items():
+                        found[(subject, session)] = session_path
+
+        with self._lock:
+            for key, session_path in sorted(found.items()):
+                if (key not in self.done and key not in self.given_up and key not in self.in_progress
+                        and key not in self.pending):
+                    log.info("Watching %s %s", *key)
+                    self.pending[key] = session_path
+
+    def _indexed_sessions(self):
+        """Return {(subject, session): path} from the layout index, None if it is unavailable."""
+        try:
+            self.layout.refresh(depth=2)
+            return {key: os.path.join(self.src, *key) for key in self.layout.sessions()}
+        except (sqlite3.Error, OSError) as e:
+            log.warning("Layout index unavailable, listing %s directly: %s", self.src, e)
+            return None
+
+    def _refresh_logs(self):
+        if os.path.isdir(self.log_dir):
+            logs = [(e.name, e.path) for e in os.scandir(self.log_dir) if e.is_file()]
+        elif os.path.isfile(self.log_dir):
+            logs = [(os.path.basename(self.log_dir), self.log_dir)]
+        else:
+            logs = []
+
+        log_mtimes = {}
+        for name, path in logs:
+            try:
+                log_mtimes[name] = os.stat(path).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            if self._log_mtimes.get(name) != log_mtimes[name]:
+                if _log_finished(path):
+                    self._finished_logs.add(name)
+                else:
+                    self._finished_logs.discard(name)
+        self._log_mtimes = log_mtimes
+        self._finished_logs &= set(log_mtimes)
+
+    def _finished_by_log(self, key):
+        """Return True / False if a log naming the session has / has not finished, None if no log names it."""
+        subject, session = key
+        finished = None
+        for name in self._log_mtimes:
+            if _names_label(name, subject) and ("ses-" not in name or _names_label(name, session)):
+                if name in self._finished_logs:
+                    return True
+                finished = False
+        return finished
+
+
+def _names_label(name, label):
+    """Return True if a file name contains a bids label, e.g. "sub-01" but not "sub-011"."""
+    return re.search(re.escape(label) + r"(?![a-zA-Z0-9])", name) is not None